@@ -3,6 +3,7 @@ from dotenv import load_dotenv  # <--- 1. Import this
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from supabase import create_client, Client
+from app.utils.metrics import stage
 
 # 2. Load environment variables before doing anything else
 load_dotenv()
@@ -26,7 +27,8 @@ def get_current_user_object(credentials: HTTPAuthorizationCredentials = Depends(
     """
     token = credentials.credentials
     try:
-        user = supabase.auth.get_user(token)
+        with stage("auth.validate_jwt"):
+            user = supabase.auth.get_user(token)
         if not user or not user.user:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
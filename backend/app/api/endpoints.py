@@ -1,30 +1,151 @@
 import shutil
 import os
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks, Depends
+import json
+import hashlib
+import tempfile
+from fastapi import APIRouter, Request, HTTPException, BackgroundTasks, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field
-from typing import List
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import MultipartParseError
+from typing import List, Optional
 
 from app.api.deps import get_current_user, get_current_user_object
 from app.db import (
     get_all_notebooks, create_notebook, add_file_to_notebook, 
-    get_notebook, add_message_to_notebook, delete_file_from_notebook,
+    get_notebook, add_message_to_notebook, delete_file_from_notebook, is_notebook_owner,
     rename_notebook, delete_notebook, delete_all_user_data,
     get_notebook_count, get_file_count_in_notebook
 )
-from app.services.ingestion import IngestionService
-from app.services.rag import RagService
+from app.services.registry import rag_services, ingestion_services
+from app.services.jobs import job_queue
+from app.services.manifest import source_manifest
+from app.services.ingestion import url_entry_name
 from app.utils.gemini_resolver import resolve_gemini_key
 from app.db import save_user_gemini_key, get_user_gemini_key, remove_user_gemini_key
 from app.utils.encryption import encrypt_key
 from app.utils.rate_limiter import check_rate_limit
+from app.utils.local_db import data_path
 
 router = APIRouter()
 
+# Uploads wait here for an ingestion worker; survives restarts, unlike the old temp_ files in cwd
+UPLOAD_DIR = data_path("uploads")
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+# Room for the boundaries, part headers and notebookId around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+def _multipart_boundary(content_type: str) -> bytes:
+    media_type, params = parse_options_header(content_type or "")
+    if media_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+    return params[b"boundary"]
+
+async def save_upload(request: Request) -> tuple:
+    """
+    Parses a multipart upload straight off the request stream: the `file` part
+    is written into its own directory under UPLOAD_DIR and hashed as it
+    arrives, other fields are kept in memory. Returns (fields, upload) where
+    upload holds path, filename, content_type and sha256. Raises UploadTooLarge
+    as soon as the stream passes the limit, leaving nothing behind.
+    """
+    boundary = _multipart_boundary(request.headers.get("content-type"))
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    # One directory per request: same-named concurrent uploads can't collide
+    upload_dir = tempfile.mkdtemp(dir=UPLOAD_DIR)
+    fields, upload = {}, None
+    digest = hashlib.sha256()
+    size = 0
+    # Per-part state while the parser walks the body
+    part = {"headers": {}, "field": b"", "value": b"", "name": None, "out": None}
+
+    def on_part_begin():
+        part.update(headers={}, field=b"", value=b"", name=None, out=None)
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"], part["value"] = b"", b""
+
+    def on_headers_finished():
+        nonlocal upload
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = options.get(b"name", b"").decode("utf-8", "replace")
+        if part["name"] == "file" and upload is None:
+            filename = options.get(b"filename", b"").decode("utf-8", "replace")
+            path = os.path.join(upload_dir, os.path.basename(filename) or "upload")
+            content_type = part["headers"].get(b"content-type", b"application/octet-stream")
+            upload = {"path": path, "filename": filename, "content_type": content_type.decode("latin-1")}
+            part["out"] = open(path, "wb")
+        else:
+            fields[part["name"]] = b""
+
+    def on_part_data(data, start, end):
+        nonlocal size
+        chunk = data[start:end]
+        if part["out"] is not None:
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge()
+            digest.update(chunk)
+            part["out"].write(chunk)
+        else:
+            fields[part["name"]] += chunk
+
+    def on_part_end():
+        if part["out"] is not None:
+            part["out"].close()
+            part["out"] = None
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    received = 0
+    try:
+        async for chunk in request.stream():
+            # Caps chunked bodies (no Content-Length) and oversized non-file fields too
+            received += len(chunk)
+            if received > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+                raise UploadTooLarge()
+            parser.write(chunk)
+        parser.finalize()
+    except MultipartParseError:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="Malformed multipart upload")
+    except BaseException:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+    finally:
+        if part["out"] is not None:
+            part["out"].close()
+    if upload is None:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="No file uploaded")
+    upload["sha256"] = digest.hexdigest()
+    return {name: value.decode("utf-8", "replace") for name, value in fields.items()}, upload
+
+# Services are pooled per API key so BYOK users keep warm clients across requests
 def get_ingestion_service(api_key: str):
-    return IngestionService(google_api_key=api_key)
+    return ingestion_services.get(api_key)
 
 def get_rag_service(api_key: str):
-    return RagService(google_api_key=api_key)
+    return rag_services.get(api_key)
 
 # --- Models ---
 class CreateNotebookRequest(BaseModel):
@@ -36,6 +157,13 @@ class SaveKeyRequest(BaseModel):
 class ChatRequest(BaseModel):
     message: str = Field(..., max_length=2000)
     notebookId: str
+    # Optional: answer only from these notebook files
+    fileNames: Optional[List[str]] = Field(None, max_length=20)
+
+class ChatBatchRequest(BaseModel):
+    # Each question counts against the daily rate limit; the batch is one request per minute
+    messages: List[str] = Field(..., min_length=1, max_length=20)
+    notebookId: str
 
 class UrlIngestRequest(BaseModel):
     url: str
@@ -110,6 +238,11 @@ def remove_notebook(notebook_id: str, user_id: str = Depends(get_current_user)):
 def delete_file(notebook_id: str, filename: str, user_id: str = Depends(get_current_user)):
     try:
         delete_file_from_notebook(notebook_id, filename, user_id)
+        # Also stops a job still ingesting this file; the worker removes what it indexes after this point
+        job_queue.forget_file(notebook_id, filename)
+        # Remove exactly this file's vectors (by the ids in its manifest); server key, as in remove_notebook
+        dummy_key = os.getenv("GOOGLE_API_KEY", "dummy_key")
+        get_ingestion_service(dummy_key).delete_file_content(notebook_id, filename)
         return {"status": "deleted"}
     except Exception as e:
         import traceback
@@ -117,30 +250,39 @@ def delete_file(notebook_id: str, filename: str, user_id: str = Depends(get_curr
         raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
 
 # --- Chat Route (ROLLED BACK TO STANDARD) ---
+def update_conversation_memory(rag_service, notebook_id: str):
+    # Runs after the response is sent; a failed summary just retries next turn
+    try:
+        rag_service.update_memory(notebook_id)
+    except Exception as e:
+        print(f"Memory Update Failed: {e}")
+
 @router.post("/chat")
-async def chat(request: ChatRequest, current_user = Depends(get_current_user_object)):
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks, current_user = Depends(get_current_user_object)):
     user_id = current_user.id
     user_email = current_user.email
     
     # Apply Rate Limiting
-    check_rate_limit(user_id)
+    # Blocking calls (Redis, Supabase, key decryption, client setup) run in the
+    # threadpool so one slow request never stalls the event loop
+    await run_in_threadpool(check_rate_limit, user_id)
     
     try:
         # 0. Resolve the Gemini API Key for the user
-        gemini_api_key = resolve_gemini_key(user_id, user_email)
+        gemini_api_key = await run_in_threadpool(resolve_gemini_key, user_id, user_email)
         
-        # 1. Instantiate Dynamic RagService
-        dynamic_rag_service = get_rag_service(gemini_api_key)
+        # 1. Get the pooled RagService for this key
+        dynamic_rag_service = await run_in_threadpool(get_rag_service, gemini_api_key)
         
         # 2. Save User Message
-        add_message_to_notebook(request.notebookId, "user", request.message, [], user_id)
+        await run_in_threadpool(add_message_to_notebook, request.notebookId, "user", request.message, [], user_id)
         
-        # 3. Get Full Answer (No Streaming)
-        # We call the standard .chat() method, not .stream_chat()
-        result = dynamic_rag_service.chat(request.message, request.notebookId)
+        # 3. Get Full Answer (No Streaming, fully async)
+        result = await dynamic_rag_service.achat(request.message, request.notebookId, use_memory=True, file_names=request.fileNames)
         
-        # 4. Save Assistant Message
-        add_message_to_notebook(request.notebookId, "assistant", result["answer"], result["sources"], user_id)
+        # 4. Save Assistant Message, then fold old turns into the rolling summary
+        await run_in_threadpool(add_message_to_notebook, request.notebookId, "assistant", result["answer"], result["sources"], user_id)
+        background_tasks.add_task(update_conversation_memory, dynamic_rag_service, request.notebookId)
         
         # 5. Return JSON
         return {"answer": result["answer"], "sources": result["sources"]}
@@ -164,61 +306,157 @@ async def chat(request: ChatRequest, current_user = Depends(get_current_user_obj
              
         raise HTTPException(status_code=500, detail=error_msg)
 
+# --- Batch Chat Route (evaluation / bulk Q&A, not saved to the notebook) ---
+@router.post("/chat/batch")
+async def chat_batch(request: ChatBatchRequest, current_user = Depends(get_current_user_object)):
+    user_id = current_user.id
+    user_email = current_user.email
+
+    if any(len(m) > 2000 for m in request.messages):
+        raise HTTPException(status_code=400, detail="Each message must be at most 2000 characters.")
+
+    # Nothing is saved to the notebook here, so ownership must be checked explicitly
+    if not await run_in_threadpool(is_notebook_owner, request.notebookId, user_id):
+        raise HTTPException(status_code=404, detail="Notebook not found")
+
+    # Every question is a generation, so each counts against the daily limit
+    await run_in_threadpool(check_rate_limit, user_id, len(request.messages))
+
+    try:
+        gemini_api_key = await run_in_threadpool(resolve_gemini_key, user_id, user_email)
+        dynamic_rag_service = await run_in_threadpool(get_rag_service, gemini_api_key)
+
+        # Per-question failures come back in place; only whole-batch failures raise
+        results = await dynamic_rag_service.chat_batch(request.messages, request.notebookId)
+        return {"results": results}
+
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        error_msg = str(e)
+        print(f"Chat Batch Error: {error_msg}")
+        if "API_KEY_INVALID" in error_msg or "401" in error_msg or "403" in error_msg:
+             raise HTTPException(
+                 status_code=401, 
+                 detail="Your Gemini API key is invalid or exhausted. Please update it."
+             )
+        raise HTTPException(status_code=500, detail=error_msg)
+
+def _sse(event: str, data) -> str:
+    """Formats one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# --- Streaming Chat Route (Server-Sent Events) ---
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, current_user = Depends(get_current_user_object)):
+    user_id = current_user.id
+    user_email = current_user.email
+    
+    # Apply Rate Limiting
+    await run_in_threadpool(check_rate_limit, user_id)
+    
+    # Key problems surface as normal HTTP errors, before the stream starts
+    gemini_api_key = await run_in_threadpool(resolve_gemini_key, user_id, user_email)
+    dynamic_rag_service = await run_in_threadpool(get_rag_service, gemini_api_key)
+    
+    try:
+        await run_in_threadpool(add_message_to_notebook, request.notebookId, "user", request.message, [], user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_stream():
+        try:
+            async for event in dynamic_rag_service.stream_chat(request.message, request.notebookId, use_memory=True, file_names=request.fileNames):
+                if event["event"] == "done":
+                    # Save the assistant message once the stream has completed
+                    result = event["data"]
+                    await run_in_threadpool(add_message_to_notebook, request.notebookId, "assistant", result["answer"], result["sources"], user_id)
+                yield _sse(event["event"], event["data"])
+        except Exception as e:
+            error_msg = str(e)
+            print(f"Chat Stream Error: {error_msg}")
+            if "API_KEY_INVALID" in error_msg or "401" in error_msg or "403" in error_msg:
+                error_msg = "Your Gemini API key is invalid or exhausted. Please update it."
+            yield _sse("error", {"detail": error_msg})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(update_conversation_memory, dynamic_rag_service, request.notebookId)
+    )
+
 # --- Ingestion Routes ---
 @router.post("/upload")
 async def upload_document(
-    background_tasks: BackgroundTasks, 
-    file: UploadFile = File(...),
-    notebookId: str = Form(...),
+    request: Request,
     current_user = Depends(get_current_user_object)
 ):
+    # The multipart body is parsed here from request.stream() rather than by
+    # File()/Form() params, which would spool the whole body before this runs
     try:
         user_id = current_user.id
         user_email = current_user.email
         
         # Apply Rate Limiting
         check_rate_limit(user_id)
-        
-        # Payload Validation (10MB limit)
-        if hasattr(file, 'size') and file.size and file.size > 10 * 1024 * 1024:
+
+        # Payload Validation (10MB limit): refuse a declared oversize body before
+        # reading any of it; enforced again while streaming, since size may be unknown
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
             raise HTTPException(status_code=400, detail="File too large (max 10MB)")
-            
-        # Check Storage Limit: Max 2 files per notebook
-        count = get_file_count_in_notebook(notebookId)
-        if count >= 2:
-            raise HTTPException(status_code=403, detail="Maximum limit of 2 files per notebook reached.")
-        
         
         # Resolve the API key eagerly. This prevents uploading if key is missing.
-        gemini_api_key = resolve_gemini_key(user_id, user_email)
+        # (The worker resolves it again when the job runs; it is never stored.)
+        resolve_gemini_key(user_id, user_email)
+
+        try:
+            fields, upload = await save_upload(request)
+        except UploadTooLarge:
+            raise HTTPException(status_code=400, detail="File too large (max 10MB)")
+        file_location = upload["path"]
+        filename = upload["filename"]
+        content_type = upload["content_type"]
+        notebookId = fields.get("notebookId")
+
+        try:
+            if not notebookId:
+                raise HTTPException(status_code=400, detail="notebookId is required")
 
-        allowed_types = ["application/pdf", "text/plain", "application/octet-stream"]
-        if file.content_type not in allowed_types and not file.filename.endswith(".txt"):
-            raise HTTPException(status_code=400, detail="Only PDF or TXT allowed")
-
-        file_location = f"temp_{file.filename}"
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
-
-        add_file_to_notebook(notebookId, file.filename, user_id)
-
-        def background_ingestion(path, n_id, f_name, c_type, g_api_key):
-            try:
-                dynamic_ingestion_service = get_ingestion_service(g_api_key)
-                if c_type == "application/pdf" or f_name.endswith(".pdf"):
-                    dynamic_ingestion_service.process_pdf(path, n_id)
-                else:
-                    dynamic_ingestion_service.process_text_file(path, n_id)
-            except Exception as e:
-                import traceback
-                print(f"Ingestion Failed: {e}")
-                traceback.print_exc()
-            finally:
-                if os.path.exists(path):
-                    os.remove(path)
-
-        background_tasks.add_task(background_ingestion, file_location, notebookId, file.filename, file.content_type, gemini_api_key)
-        return {"message": "Upload started"}
+            # Before anything else touches the notebook: the duplicate check below
+            # would otherwise tell anyone whether given bytes exist in it
+            if not is_notebook_owner(notebookId, user_id):
+                raise HTTPException(status_code=404, detail="Notebook not found")
+
+            # Check Storage Limit: Max 2 files per notebook
+            count = get_file_count_in_notebook(notebookId)
+            if count >= 2:
+                raise HTTPException(status_code=403, detail="Maximum limit of 2 files per notebook reached.")
+
+            allowed_types = ["application/pdf", "text/plain", "application/octet-stream"]
+            if content_type not in allowed_types and not filename.endswith(".txt"):
+                raise HTTPException(status_code=400, detail="Only PDF or TXT allowed")
+
+            # Same bytes already queued or indexed in this notebook: nothing to parse or embed
+            existing = job_queue.find_duplicate(notebookId, upload["sha256"])
+        except BaseException:
+            shutil.rmtree(os.path.dirname(file_location), ignore_errors=True)
+            raise
+        if existing:
+            shutil.rmtree(os.path.dirname(file_location), ignore_errors=True)
+            return {"message": "File already uploaded", "jobId": existing["id"], "duplicate": True}
+
+        add_file_to_notebook(notebookId, filename, user_id)
+
+        # Ingestion runs in the worker processes (app/services/job_worker.py), not in this one
+        kind = "pdf" if content_type == "application/pdf" or filename.endswith(".pdf") else "text"
+        job = job_queue.enqueue(
+            user_id, notebookId, kind,
+            {"path": file_location, "filename": filename, "user_email": user_email},
+            content_hash=upload["sha256"]
+        )
+        return {"message": "Upload started", "jobId": job["id"]}
         
     except HTTPException as he:
         raise he
@@ -246,7 +484,8 @@ async def ingest_url(request: UrlIngestRequest, current_user = Depends(get_curre
         dynamic_ingestion_service = get_ingestion_service(gemini_api_key)
         
         title = dynamic_ingestion_service.process_url(request.url, request.notebookId)
-        entry_name = f"WEB: {title[:20].strip()}..." 
+        # Same name the chunks and manifest were recorded under, so filters and deletion find them
+        entry_name = url_entry_name(title)
         add_file_to_notebook(request.notebookId, entry_name, user_id)
         return {"status": "success", "title": title}
     except HTTPException as he:
@@ -256,6 +495,44 @@ async def ingest_url(request: UrlIngestRequest, current_user = Depends(get_curre
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Ingest URL failed: {str(e)}")
 
+@router.post("/refresh-url")
+def refresh_url(request: UrlIngestRequest, current_user = Depends(get_current_user_object)):
+    # Incremental: 304 -> no work; otherwise only changed chunks are re-embedded
+    try:
+        user_id = current_user.id
+        check_rate_limit(user_id)
+        gemini_api_key = resolve_gemini_key(user_id, current_user.email)
+        if not get_notebook(request.notebookId, user_id):
+            raise HTTPException(status_code=404, detail="Notebook not found")
+        # Only URLs already ingested here: a first ingest must go through /ingest-url
+        # (file limit, notebook entry, per-file deletion)
+        if source_manifest.get(request.notebookId, request.url) is None:
+            raise HTTPException(status_code=404, detail="URL not found in this notebook")
+
+        dynamic_ingestion_service = get_ingestion_service(gemini_api_key)
+        return dynamic_ingestion_service.refresh_url(request.url, request.notebookId)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Refresh URL failed: {str(e)}")
+
+# --- Ingestion Job Status ---
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str, user_id: str = Depends(get_current_user)):
+    job = job_queue.get(job_id, user_id=user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/notebooks/{notebook_id}/jobs")
+def list_notebook_jobs(notebook_id: str, user_id: str = Depends(get_current_user)):
+    try:
+        return job_queue.list_for_notebook(notebook_id, user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to list jobs: {str(e)}")
+
 # --- BYOK Route ---
 @router.post("/user/gemini-key")
 async def save_user_key(request: SaveKeyRequest, current_user = Depends(get_current_user_object)):
@@ -2,6 +2,9 @@ import os
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import uuid
+from datetime import datetime, timezone
+from app.utils.answer_cache import answer_cache
+from app.utils.metrics import timed
 
 load_dotenv()
 
@@ -16,6 +19,7 @@ supabase: Client = create_client(url, key)
 
 # --- Gemini API Key Operations ---
 
+@timed("supabase.save_user_gemini_key")
 def save_user_gemini_key(user_id: str, encrypted_key: str):
     try:
         response = supabase.table("user_keys").upsert({
@@ -27,6 +31,7 @@ def save_user_gemini_key(user_id: str, encrypted_key: str):
         print(f"Error saving to user_keys in Supabase: {e}")
         return False
 
+@timed("supabase.get_user_gemini_key")
 def get_user_gemini_key(user_id: str):
     try:
         response = supabase.table("user_keys").select("encrypted_gemini_key").eq("user_id", user_id).execute()
@@ -37,6 +42,7 @@ def get_user_gemini_key(user_id: str):
         print(f"Error fetching user_keys from Supabase: {e}")
         return None
 
+@timed("supabase.remove_user_gemini_key")
 def remove_user_gemini_key(user_id: str):
     try:
         supabase.table("user_keys").delete().eq("user_id", user_id).execute()
@@ -47,6 +53,7 @@ def remove_user_gemini_key(user_id: str):
 
 # --- Notebook Operations ---
 
+@timed("supabase.get_all_notebooks")
 def get_all_notebooks(user_id: str):
     try:
         # Select all notebooks for the SPECIFIC user, ordered by newest
@@ -71,6 +78,7 @@ def get_all_notebooks(user_id: str):
         print(f"Error fetching notebooks: {e}")
         return []
 
+@timed("supabase.create_notebook")
 def create_notebook(name: str, user_id: str):
     response = supabase.table("notebooks").insert({
         "name": name,
@@ -82,6 +90,7 @@ def create_notebook(name: str, user_id: str):
     new_notebook['files'] = [] 
     return new_notebook
 
+@timed("supabase.get_notebook")
 def get_notebook(notebook_id: str, user_id: str):
     try:
         # Get Metadata - WITH SECURITY CHECK
@@ -117,6 +126,7 @@ def get_notebook(notebook_id: str, user_id: str):
         print(f"Error fetching notebook details: {e}")
         return None
 
+@timed("supabase.rename_notebook")
 def rename_notebook(notebook_id: str, new_name: str, user_id: str):
     response = supabase.table("notebooks") \
         .update({"name": new_name}) \
@@ -125,6 +135,7 @@ def rename_notebook(notebook_id: str, new_name: str, user_id: str):
         .execute()
     return response.data[0] if response.data else None
 
+@timed("supabase.delete_notebook")
 def delete_notebook(notebook_id: str, user_id: str):
     # Only delete if user owns it
     supabase.table("notebooks") \
@@ -134,6 +145,7 @@ def delete_notebook(notebook_id: str, user_id: str):
         .execute()
     return True
 
+@timed("supabase.get_notebook_count")
 def get_notebook_count(user_id: str) -> int:
     try:
         response = supabase.table("notebooks").select("id", count="exact").eq("user_id", user_id).execute()
@@ -144,6 +156,13 @@ def get_notebook_count(user_id: str) -> int:
 
 # --- File Operations ---
 
+@timed("supabase.is_notebook_owner")
+def is_notebook_owner(notebook_id: str, user_id: str) -> bool:
+    # Same check add_file_to_notebook does, for routes that write nothing
+    check = supabase.table("notebooks").select("id").eq("id", notebook_id).eq("user_id", user_id).execute()
+    return bool(check.data)
+
+@timed("supabase.add_file_to_notebook")
 def add_file_to_notebook(notebook_id: str, filename: str, user_id: str):
     # 1. SECURITY: Verify notebook belongs to user first
     check = supabase.table("notebooks").select("id").eq("id", notebook_id).eq("user_id", user_id).execute()
@@ -163,6 +182,7 @@ def add_file_to_notebook(notebook_id: str, filename: str, user_id: str):
             "name": filename
         }).execute()
 
+@timed("supabase.delete_file_from_notebook")
 def delete_file_from_notebook(notebook_id: str, filename: str, user_id: str):
     # 1. SECURITY: Verify notebook belongs to user
     check = supabase.table("notebooks").select("id").eq("id", notebook_id).eq("user_id", user_id).execute()
@@ -176,6 +196,10 @@ def delete_file_from_notebook(notebook_id: str, filename: str, user_id: str):
         .eq("name", filename) \
         .execute()
 
+    # Cached answers may cite the removed file
+    answer_cache.invalidate(notebook_id)
+
+@timed("supabase.get_file_count_in_notebook")
 def get_file_count_in_notebook(notebook_id: str) -> int:
     try:
         response = supabase.table("files").select("id", count="exact").eq("notebook_id", notebook_id).execute()
@@ -186,6 +210,7 @@ def get_file_count_in_notebook(notebook_id: str) -> int:
 
 # --- Chat Operations ---
 
+@timed("supabase.add_message_to_notebook")
 def add_message_to_notebook(notebook_id: str, role: str, content: str, sources: list = None, user_id: str = None):
     # 1. SECURITY: Verify notebook belongs to user (if user_id provided)
     if user_id:
@@ -200,8 +225,57 @@ def add_message_to_notebook(notebook_id: str, role: str, content: str, sources:
         "sources": sources or []
     }).execute()
 
+@timed("supabase.get_recent_messages")
+def get_recent_messages(notebook_id: str, limit: int):
+    """Returns the newest `limit` messages, oldest first."""
+    response = supabase.table("messages") \
+        .select("role, content, created_at") \
+        .eq("notebook_id", notebook_id) \
+        .order("created_at", desc=True) \
+        .limit(limit) \
+        .execute()
+    return list(reversed(response.data or []))
+
+@timed("supabase.get_messages_between")
+def get_messages_between(notebook_id: str, after: str, before: str, limit: int):
+    """Messages with after < created_at < before (after may be None), oldest first."""
+    query = supabase.table("messages") \
+        .select("role, content, created_at") \
+        .eq("notebook_id", notebook_id) \
+        .lt("created_at", before)
+    if after:
+        query = query.gt("created_at", after)
+    response = query.order("created_at", desc=False).limit(limit).execute()
+    return response.data or []
+
+# --- Conversation Memory ---
+# Table: conversation_summaries (notebook_id uuid primary key references notebooks on delete cascade,
+#        summary text, summarized_until timestamptz, updated_at timestamptz default now())
+
+@timed("supabase.get_conversation_summary")
+def get_conversation_summary(notebook_id: str):
+    try:
+        response = supabase.table("conversation_summaries") \
+            .select("summary, summarized_until") \
+            .eq("notebook_id", notebook_id) \
+            .execute()
+        return response.data[0] if response.data else None
+    except Exception as e:
+        print(f"Error fetching conversation summary: {e}")
+        return None
+
+@timed("supabase.save_conversation_summary")
+def save_conversation_summary(notebook_id: str, summary: str, summarized_until: str):
+    supabase.table("conversation_summaries").upsert({
+        "notebook_id": notebook_id,
+        "summary": summary,
+        "summarized_until": summarized_until,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }).execute()
+
 # --- User Management ---
 
+@timed("supabase.delete_all_user_data")
 def delete_all_user_data(user_id: str):
     """
     Nuclear Option: Deletes all notebooks, files, and messages for a user.
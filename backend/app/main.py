@@ -1,11 +1,36 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.endpoints import router
+from app.services.registry import get_registry_stats, rag_services, ingestion_services
+from app.services.vector_store import get_vector_store
+from app.services.job_worker import start_worker_pool, stop_worker_pool
+from app.utils.answer_cache import answer_cache
+from app.utils.search_cache import search_cache
+from app.utils.metrics import ServerTimingMiddleware, metrics_response_body
 
-app = FastAPI(title="RAG Portfolio API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Verify/create the vector index once, so uploads and chats never pay for it
+    try:
+        await run_in_threadpool(get_vector_store().ensure_ready)
+    except Exception as e:
+        # Not fatal: ingestion calls ensure_ready() again before its first upsert
+        print(f"⚠️ Vector store not ready at startup: {e}")
+    # Ingestion runs in separate, lower-priority processes so it never competes
+    # with chat for this process's threadpool (INGESTION_WORKERS=0 to run them elsewhere)
+    workers = start_worker_pool()
+    yield
+    stop_worker_pool(workers)
+    # Release pooled Gemini clients
+    rag_services.clear()
+    ingestion_services.clear()
+
+app = FastAPI(title="RAG Portfolio API", lifespan=lifespan)
 
 # CORS Configuration
 origins = [
@@ -23,8 +48,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so the total includes CORS handling too
+app.add_middleware(ServerTimingMiddleware)
+
 app.include_router(router, prefix="/api")
 
 @app.get("/")
 def health_check():
-    return {"status": "ok", "version": "1.0.0"}
\ No newline at end of file
+    return {
+        "status": "ok",
+        "version": "1.0.0",
+        "service_pool": get_registry_stats(),
+        "answer_cache": answer_cache.stats(),
+        "search_cache": search_cache.stats(),
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    # Prometheus scrape endpoint: per-stage latency histograms and route latency
+    body, content_type = metrics_response_body()
+    return Response(content=body, media_type=content_type)
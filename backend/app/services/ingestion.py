@@ -1,12 +1,15 @@
 import os
-from typing import List
+from typing import Callable, List, Optional
 import tempfile
 import io
-from langchain_community.document_loaders import PyPDFLoader, WebBaseLoader, TextLoader
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-from pinecone import Pinecone, ServerlessSpec
 from dotenv import load_dotenv
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
@@ -14,23 +17,48 @@ from googleapiclient.http import MediaIoBaseDownload
 
 # --- NEW: Import Vision Parser ---
 from app.utils.vision_parser import VisionParser
+import fitz  # PyMuPDF (page count for progress)
+from app.services.vector_store import get_vector_store
+from app.utils.answer_cache import answer_cache
+from app.utils.keyword_index import keyword_index
+from app.utils.embedding_cache import CachedEmbeddings
+from app.services.manifest import source_manifest, chunk_hash, chunk_id, file_id, file_chunk_id
+from app.utils.metrics import stage
+from app.utils.rate_controller import AdaptiveRateController, is_rate_limited
 
 load_dotenv()
 
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Chunks per embedding request (Gemini accepts up to 100) and upsert
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+# Upper bound for concurrent embedding requests; the AIMD controller adapts below it
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = 6
+URL_FETCH_TIMEOUT = 30  # seconds
+URL_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+# Pages extracted, split and indexed together; bounds memory for large PDFs
+PDF_PAGE_WINDOW = int(os.getenv("PDF_PAGE_WINDOW", "20"))
 
 class IngestionService:
     def __init__(self, google_api_key: str):
-        self.pc = Pinecone(api_key=PINECONE_API_KEY)
-        self.embeddings = GoogleGenerativeAIEmbeddings(
+        self.vector_store = get_vector_store()
+        # Chunk vectors are cached by content, so re-uploads skip the Gemini call
+        self.embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(
             model="models/gemini-embedding-001", 
             google_api_key=google_api_key
-        )
+        ))
+        # Gemini quotas are per key, and so is this service
+        self.embed_rate = AdaptiveRateController(EMBED_MAX_CONCURRENCY)
         # --- NEW: Initialize Vision ---
         self.vision_parser = VisionParser(google_api_key=google_api_key)
 
+    def close(self):
+        # Release the Gemini HTTP clients (called when the service pool evicts us)
+        client = getattr(self.embeddings.embeddings, "client", None)
+        if client is not None and hasattr(client, "close"):
+            client.close()
+        self.vision_parser.close()
+
     def _get_splitter(self):
         return RecursiveCharacterTextSplitter(
             chunk_size=1000,
@@ -38,74 +66,219 @@ class IngestionService:
             separators=["\n\n", "\n", " ", ""]
         )
 
-    def _index_documents(self, chunks: List, notebook_id: str):
-        # Ensure Index
-        existing_indexes = [index.name for index in self.pc.list_indexes()]
-        if PINECONE_INDEX_NAME not in existing_indexes:
-            self.pc.create_index(
-                name=PINECONE_INDEX_NAME,
-                dimension=3072, 
-                metric="cosine",
-                spec=ServerlessSpec(cloud="aws", region="us-east-1")
-            )
+    def _index_documents(self, chunks: List, notebook_id: str, ids: Optional[List[str]] = None):
+        # Ensure Index (or local namespace dir)
+        self.vector_store.ensure_ready()
         
         print(f"Upserting {len(chunks)} chunks to namespace: {notebook_id}...")
-        PineconeVectorStore.from_documents(
-            documents=chunks,
-            embedding=self.embeddings,
-            index_name=PINECONE_INDEX_NAME,
-            namespace=notebook_id
-        )
+        batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+        id_batches = [ids[i:i + EMBED_BATCH_SIZE] if ids else None for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+        hits = 0
+        # Batches embed concurrently in the pool while this thread upserts them
+        # in order, so the upsert of batch N overlaps the embedding of N+1
+        with ThreadPoolExecutor(max_workers=EMBED_MAX_CONCURRENCY) as pool:
+            futures = [pool.submit(self._embed_batch, [c.page_content for c in batch]) for batch in batches]
+            try:
+                for batch, batch_ids, future in zip(batches, id_batches, futures):
+                    vectors, batch_hits = future.result()
+                    hits += batch_hits
+                    self.vector_store.upsert(notebook_id, vectors, batch, ids=batch_ids)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        if chunks:
+            print(f"Embedding cache: {hits}/{len(chunks)} chunks reused ({hits / len(chunks):.0%} hit rate)")
+        # Same chunks feed the BM25 keyword index used for hybrid retrieval
+        with stage("bm25.index"):
+            keyword_index.add_documents(notebook_id, chunks)
+        # New content can change answers for this notebook
+        answer_cache.invalidate(notebook_id)
+
+    def _embed_batch(self, texts: List[str]):
+        """Embeds one batch under the AIMD controller, retrying when Gemini throttles us."""
+        for attempt in range(EMBED_MAX_RETRIES + 1):
+            try:
+                with self.embed_rate.slot():
+                    result = self.embeddings.embed_documents_with_stats(texts)
+            except Exception as e:
+                if attempt == EMBED_MAX_RETRIES or not is_rate_limited(e):
+                    raise
+                self.embed_rate.on_throttle()
+                continue
+            self.embed_rate.on_success()
+            return result
+
+    def _delete_chunks(self, notebook_id: str, ids: List[str]):
+        self.vector_store.delete(notebook_id, ids)
+        keyword_index.delete_documents(notebook_id, ids)
+        answer_cache.invalidate(notebook_id)
+
+    def _start_file(self, notebook_id: str, file_name: str) -> str:
+        """Clears what an earlier upload under the same name indexed; returns the file id."""
+        previous = source_manifest.get(notebook_id, file_name)
+        if previous and previous["chunks"]:
+            print(f"Replacing {len(previous['chunks'])} chunks from an earlier upload of {file_name}")
+            self._delete_chunks(notebook_id, list(previous["chunks"].values()))
+        return file_id(notebook_id, file_name)
+
+    def _index_file_chunks(self, chunks: List, notebook_id: str, file_name: str, fid: str, indexed: dict):
+        """
+        Indexes chunks of an uploaded file under deterministic ids
+        ("<file id>-<chunk index>", continuing from `indexed`) and records them
+        in the manifest, so the file's vectors can be deleted exactly.
+        """
+        ids = []
+        for chunk in chunks:
+            index = len(indexed) + len(ids)
+            ids.append(file_chunk_id(fid, index))
+            chunk.metadata.update({"file_id": fid, "file_name": file_name, "chunk_index": index, "chunk_id": ids[-1]})
+        self._index_documents(chunks, notebook_id, ids=ids)
+        indexed.update((chunk.metadata["chunk_index"], vector_id) for chunk, vector_id in zip(chunks, ids))
+        source_manifest.save(notebook_id, file_name, indexed, file_name=file_name)
 
-    # --- UPDATED PDF PROCESSING (Text + Vision) ---
-    def process_pdf(self, file_path: str, notebook_id: str):
+    # --- UPDATED PDF PROCESSING (Text + Vision), one page window at a time ---
+    def process_pdf(self, file_path: str, notebook_id: str, progress: Optional[Callable] = None, file_name: Optional[str] = None):
+        """
+        `progress(stage, pages_done, pages_total)` is called as windows complete (job status).
+        `file_name` is the notebook entry the PDF is listed under (defaults to the file's basename).
+        """
         print(f"--- Processing PDF: {file_path} ---")
-        
-        # 1. Extract Standard Text
-        print("📄 Extracting Text...")
-        loader = PyPDFLoader(file_path)
-        text_docs = loader.load()
-        
-        # 2. Extract & Describe Images (Multimodal)
-        print("👁️ Extracting Images (Multimodal)...")
-        try:
-            image_docs = self.vision_parser.extract_and_describe_images(file_path)
-            print(f"   --> Added {len(image_docs)} image descriptions.")
-        except Exception as e:
-            print(f"❌ Vision Warning (Skipping images): {e}")
-            image_docs = []
+        splitter = self._get_splitter()
+        progress = progress or _no_progress
+        file_name = file_name or os.path.basename(file_path)
+        with fitz.open(file_path) as pdf:
+            pages_total = pdf.page_count
+        progress("extracting", 0, pages_total)
+        fid = self._start_file(notebook_id, file_name)
+        indexed = {}
 
-        # 3. Combine & Split
-        # We treat the image descriptions just like text paragraphs now
-        all_docs = text_docs + image_docs
-        chunks = self._get_splitter().split_documents(all_docs)
-        
-        # 4. Index
-        self._index_documents(chunks, notebook_id)
+        # Each window is split and indexed before the next is read, so memory
+        # stays flat however long the PDF is and early pages become searchable
+        # while later ones are still being processed
+        for pages, docs in self._iter_pdf_windows(file_path):
+            # We treat the image descriptions just like text paragraphs now
+            chunks = splitter.split_documents(_cite_as(docs, file_path, file_name))
+            print(f"📄 Pages {pages.start + 1}-{pages.stop}: {len(chunks)} chunks")
+            progress("indexing", pages.start, pages_total)
+            self._index_file_chunks(chunks, notebook_id, file_name, fid, indexed)
+            progress("extracting", pages.stop, pages_total)
+
+    def _iter_pdf_windows(self, file_path: str):
+        """Yields (0-based page range, text + image description docs) per PDF_PAGE_WINDOW pages."""
+        # lazy_load() parses one page per next(), never the whole file
+        pages = PyPDFLoader(file_path).lazy_load()
+        first_page = 0
+        seen_images = set()  # images repeated across windows are described once
+        while True:
+            # 1. Extract Standard Text
+            with stage("ingest.pdf_text"):
+                text_docs = list(islice(pages, PDF_PAGE_WINDOW))
+            if not text_docs:
+                return
+
+            window = range(first_page, first_page + len(text_docs))
+
+            # 2. Extract & Describe Images (Multimodal)
+            try:
+                with stage("ingest.vision"):
+                    image_docs = self.vision_parser.extract_and_describe_images(file_path, pages=window, seen=seen_images)
+                if image_docs:
+                    print(f"   --> Added {len(image_docs)} image descriptions.")
+            except Exception as e:
+                print(f"❌ Vision Warning (Skipping images): {e}")
+                image_docs = []
+
+            yield window, text_docs + image_docs
+            first_page = window.stop
 
     # Text/Markdown
-    def process_text_file(self, file_path: str, notebook_id: str):
+    def process_text_file(self, file_path: str, notebook_id: str, progress: Optional[Callable] = None, file_name: Optional[str] = None):
         print(f"--- Processing Text File: {file_path} ---")
+        progress = progress or _no_progress
+        file_name = file_name or os.path.basename(file_path)
         loader = TextLoader(file_path)
         docs = loader.load()
-        chunks = self._get_splitter().split_documents(docs)
-        self._index_documents(chunks, notebook_id)
+        chunks = self._get_splitter().split_documents(_cite_as(docs, file_path, file_name))
+        progress("indexing")
+        fid = self._start_file(notebook_id, file_name)
+        self._index_file_chunks(chunks, notebook_id, file_name, fid, {})
 
     # --- MODE 3: WEBSITE URL ---
     def process_url(self, url: str, notebook_id: str):
         print(f"--- Processing URL: {url} ---")
-        
-        loader = WebBaseLoader(
-            url,
-            header_template={
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
+        result = self._sync_url(url, notebook_id, conditional=False)
+        return result["title"]
+
+    def refresh_url(self, url: str, notebook_id: str) -> dict:
+        """
+        Re-ingests a URL source incrementally: a conditional GET skips all work
+        on 304, otherwise only chunks whose content changed are embedded, and
+        vectors of chunks that disappeared are deleted.
+        """
+        print(f"--- Refreshing URL: {url} ---")
+        return self._sync_url(url, notebook_id, conditional=True)
+
+    def _sync_url(self, url: str, notebook_id: str, conditional: bool) -> dict:
+        previous = source_manifest.get(notebook_id, url)
+        headers = {"User-Agent": URL_USER_AGENT}
+        if conditional and previous:
+            if previous["etag"]:
+                headers["If-None-Match"] = previous["etag"]
+            if previous["last_modified"]:
+                headers["If-Modified-Since"] = previous["last_modified"]
+
+        with stage("ingest.fetch_url"):
+            response = requests.get(url, headers=headers, timeout=URL_FETCH_TIMEOUT)
+        if response.status_code == 304:
+            print("   --> Not modified (304), nothing to do")
+            return {"status": "unchanged", "title": url, "added": 0, "removed": 0}
+        response.raise_for_status()
+
+        # Same text and metadata WebBaseLoader produced
+        soup = BeautifulSoup(response.text, "html.parser")
+        metadata = {"source": url}
+        if title := soup.find("title"):
+            metadata["title"] = title.get_text()
+        if description := soup.find("meta", attrs={"name": "description"}):
+            metadata["description"] = description.get("content", "No description found.")
+        if html := soup.find("html"):
+            metadata["language"] = html.get("lang", "No language found.")
+        chunks = self._get_splitter().split_documents([Document(page_content=soup.get_text(), metadata=metadata)])
+
+        # Chunks carry the notebook entry name so chat can filter by it. A
+        # refresh keeps the entry the URL was first listed under.
+        if conditional and previous and previous["file_name"]:
+            file_name = previous["file_name"]
+        else:
+            file_name = url_entry_name(metadata.get("title", url))
+
+        # Diff by content hash; unchanged chunks keep their vectors untouched
+        old_chunks = previous["chunks"] if previous else {}
+        new_chunks, to_index = {}, []
+        for chunk in chunks:
+            content_hash = chunk_hash(chunk.page_content)
+            if content_hash in new_chunks:
+                continue
+            new_chunks[content_hash] = chunk_id(notebook_id, url, content_hash)
+            if content_hash not in old_chunks:
+                chunk.metadata.update({"chunk_id": new_chunks[content_hash], "file_name": file_name})
+                to_index.append(chunk)
+        removed = [vector_id for content_hash, vector_id in old_chunks.items() if content_hash not in new_chunks]
+
+        if to_index:
+            self._index_documents(to_index, notebook_id, ids=[c.metadata["chunk_id"] for c in to_index])
+        if removed:
+            self._delete_chunks(notebook_id, removed)
+        print(f"   --> {len(to_index)} chunks added, {len(removed)} removed, {len(new_chunks) - len(to_index)} unchanged")
+
+        source_manifest.save(
+            notebook_id, url, new_chunks,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            file_name=file_name
         )
-        docs = loader.load()
-        chunks = self._get_splitter().split_documents(docs)
-        self._index_documents(chunks, notebook_id)
-        
-        return docs[0].metadata.get('title', url)
+        return {"status": "updated", "title": metadata.get("title", url), "added": len(to_index), "removed": len(removed)}
 
     # MODE 4: GOOGLE DRIVE FILE ---
     def process_drive_file(self, file_id: str, access_token: str, notebook_id: str):
@@ -132,9 +305,9 @@ class IngestionService:
 
             try:
                 if filename.endswith(".pdf"):
-                    self.process_pdf(temp_filename, notebook_id)
+                    self.process_pdf(temp_filename, notebook_id, file_name=filename)
                 else:
-                    self.process_text_file(temp_filename, notebook_id)
+                    self.process_text_file(temp_filename, notebook_id, file_name=filename)
                 
                 return filename 
             finally:
@@ -145,10 +318,45 @@ class IngestionService:
             print(f"Drive Ingestion Error: {e}")
             raise e
 
+    def delete_file_content(self, notebook_id: str, file_name: str) -> int:
+        """
+        Removes exactly the vectors (and BM25 rows) of one notebook entry, by
+        the ids recorded in its manifest; Pinecone deletes run in batches of
+        1000 ids. Returns how many chunks were deleted.
+        """
+        sources = source_manifest.find_by_file(notebook_id, file_name)
+        ids = [vector_id for vector_ids in sources.values() for vector_id in vector_ids]
+        if not sources:
+            # Nothing indexed yet, or ingested before manifests existed (only deleting the notebook clears those)
+            print(f"No chunks recorded for {file_name} in {notebook_id}")
+            return 0
+        if ids:
+            self._delete_chunks(notebook_id, ids)
+        for source in sources:
+            source_manifest.delete(notebook_id, source)
+        print(f"Deleted {len(ids)} chunks of {file_name} from namespace: {notebook_id}")
+        return len(ids)
+
     def delete_notebook_content(self, notebook_id: str):
         try:
-            index = self.pc.Index(PINECONE_INDEX_NAME)
-            index.delete(delete_all=True, namespace=notebook_id)
+            self.vector_store.delete_namespace(notebook_id)
+            keyword_index.delete_namespace(notebook_id)
+            source_manifest.delete_notebook(notebook_id)
+            answer_cache.invalidate(notebook_id)
             print(f"Deleted all vectors for namespace: {notebook_id}")
         except Exception as e:
-            print(f"Failed to delete namespace {notebook_id}: {e}")
\ No newline at end of file
+            print(f"Failed to delete namespace {notebook_id}: {e}")
+
+def url_entry_name(title: str) -> str:
+    """Name a URL source is listed under in its notebook."""
+    return f"WEB: {title[:20].strip()}..."
+
+def _cite_as(docs: List, file_path: str, file_name: str) -> List:
+    # Loaders record the temp upload path as "source", which the UI shows as the citation
+    for doc in docs:
+        if doc.metadata.get("source") == file_path:
+            doc.metadata["source"] = file_name
+    return docs
+
+def _no_progress(stage: str, pages_done: int = None, pages_total: int = None):
+    pass
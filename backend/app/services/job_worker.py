@@ -0,0 +1,120 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import time
+import threading
+import traceback
+import multiprocessing
+from typing import List
+
+from app.services.jobs import job_queue, JobCancelled
+from app.services.registry import ingestion_services
+from app.utils.gemini_resolver import resolve_gemini_key
+
+# Configuration
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))  # 0 = run workers separately
+JOB_POLL_INTERVAL = 1.0  # seconds between queue polls when idle
+JOB_HEARTBEAT_INTERVAL = 30.0
+WORKER_NICENESS = 10  # below the API process, so chat keeps the CPU
+
+def run_job(job: dict):
+    """Runs one claimed ingestion job and records progress on it."""
+    payload = job["payload"]
+    path = payload["path"]
+
+    def check_cancelled():
+        if job_queue.is_cancel_requested(job["id"]):
+            raise JobCancelled()
+
+    def progress(stage: str, pages_done: int = None, pages_total: int = None):
+        # Called between page windows, so a deleted file stops within one window
+        job_queue.update_progress(job["id"], stage, pages_done, pages_total)
+        check_cancelled()
+
+    try:
+        # Deleted while still queued: nothing was indexed yet
+        check_cancelled()
+        # Resolved here rather than stored with the job, so no key sits on disk
+        api_key = resolve_gemini_key(job["user_id"], payload.get("user_email"))
+        service = ingestion_services.get(api_key)
+        # Chunks are recorded under the notebook entry name, so deleting the entry finds them
+        file_name = payload.get("filename")
+        try:
+            if job["kind"] == "pdf":
+                service.process_pdf(path, job["notebook_id"], progress=progress, file_name=file_name)
+            else:
+                service.process_text_file(path, job["notebook_id"], progress=progress, file_name=file_name)
+            check_cancelled()
+        except JobCancelled:
+            # The delete already removed what was indexed then; this removes
+            # the windows indexed since, which re-saved the manifest
+            service.delete_file_content(job["notebook_id"], file_name)
+            raise
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        # Each upload has its own directory (see save_upload); rmdir only if now empty
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+def _heartbeat(job_id: str, done: threading.Event):
+    # Long windows (many images) can go minutes without a progress update
+    while not done.wait(JOB_HEARTBEAT_INTERVAL):
+        job_queue.heartbeat(job_id)
+
+def run_worker(worker_id: str):
+    """Claims and runs jobs until the process is terminated."""
+    if hasattr(os, "nice"):
+        os.nice(WORKER_NICENESS)
+    print(f"🛠️ Ingestion worker {worker_id} started (pid {os.getpid()})")
+
+    while True:
+        try:
+            job = job_queue.claim(worker_id)
+        except Exception as e:
+            print(f"Job queue error: {e}")
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        print(f"--- Job {job['id']} ({job['kind']}) for notebook {job['notebook_id']} ---")
+        done = threading.Event()
+        threading.Thread(target=_heartbeat, args=(job["id"], done), daemon=True).start()
+        try:
+            run_job(job)
+            job_queue.finish(job["id"])
+        except JobCancelled:
+            print(f"Job {job['id']} cancelled: its file was deleted")
+            job_queue.finish(job["id"], cancelled=True)
+        except Exception as e:
+            print(f"Ingestion Failed: {e}")
+            traceback.print_exc()
+            job_queue.finish(job["id"], error=str(e))
+        finally:
+            done.set()
+
+def start_worker_pool(count: int = INGESTION_WORKERS) -> List[multiprocessing.Process]:
+    """Starts `count` worker processes (spawned, so they don't inherit the API's threads)."""
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for i in range(count):
+        process = context.Process(target=run_worker, args=(f"worker-{i}",), daemon=True, name=f"ingestion-worker-{i}")
+        process.start()
+        processes.append(process)
+    return processes
+
+def stop_worker_pool(processes: List[multiprocessing.Process]):
+    # Interrupted jobs are picked up again once their heartbeat goes stale
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout=10)
+
+if __name__ == "__main__":
+    # Standalone workers: INGESTION_WORKERS=0 for the API, then `python -m app.services.job_worker`.
+    # Point PROMETHEUS_MULTIPROC_DIR at the API's directory for /metrics to include them.
+    run_worker(f"worker-{os.getpid()}")
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Optional
+
+from app.utils.local_db import data_path
+
+# Configuration
+JOBS_DB_PATH = data_path("jobs.sqlite")
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "1"))   # running jobs per user
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "600"))    # seconds without a heartbeat
+JOB_MAX_ATTEMPTS = 2  # a job interrupted by a crash/restart is retried once
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    notebook_id TEXT NOT NULL,
+    kind TEXT NOT NULL,             -- "pdf" | "text"
+    payload TEXT NOT NULL,          -- JSON: file path, filename, user email
+    content_hash TEXT,              -- SHA-256 of the uploaded bytes
+    priority INTEGER NOT NULL DEFAULT 0,  -- unused (jobs run oldest first); kept for existing queue files
+    status TEXT NOT NULL,           -- queued | running | succeeded | failed | cancelled
+    cancel_requested INTEGER NOT NULL DEFAULT 0,  -- file deleted; the worker stops and cleans up
+    stage TEXT,                     -- e.g. extracting, indexing
+    pages_done INTEGER NOT NULL DEFAULT 0,
+    pages_total INTEGER,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_fifo ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_notebook ON jobs (notebook_id, created_at);
+CREATE INDEX IF NOT EXISTS jobs_content ON jobs (notebook_id, content_hash);
+"""
+
+# Columns returned by the status API (payload stays internal)
+PUBLIC_FIELDS = (
+    "id", "notebook_id", "kind", "content_hash", "status", "stage", "pages_done",
+    "pages_total", "error", "attempts", "created_at", "started_at", "finished_at"
+)
+
+class JobCancelled(Exception):
+    """Raised inside a job whose file was deleted from the notebook."""
+
+class JobQueue:
+    """
+    Durable ingestion queue in a local SQLite file, shared by the API process
+    (which enqueues and reports status) and the worker processes (which claim
+    and run jobs). Every call opens its own connection, so it is safe across
+    processes and threads; claims are atomic under BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self.path = path
+        self._initialized = False
+
+    @contextmanager
+    def _connect(self, immediate: bool = False):
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self._initialized:
+                conn.execute("PRAGMA journal_mode=WAL")
+                columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+                if columns and "content_hash" not in columns:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN content_hash TEXT")
+                if columns and "cancel_requested" not in columns:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+                conn.executescript(SCHEMA)
+                self._initialized = True
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def enqueue(self, user_id: str, notebook_id: str, kind: str, payload: dict, content_hash: Optional[str] = None) -> dict:
+        job_id = str(uuid.uuid4())
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, user_id, notebook_id, kind, payload, content_hash, priority, status, stage, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, 'queued', 'queued', ?)",
+                (job_id, user_id, notebook_id, kind, json.dumps(payload), content_hash, time.time())
+            )
+        return self.get(job_id)
+
+    def find_duplicate(self, notebook_id: str, content_hash: str) -> Optional[dict]:
+        """A queued, running or successful job for the same bytes in the same notebook, if any."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE notebook_id = ? AND content_hash = ? "
+                "AND status IN ('queued', 'running', 'succeeded') ORDER BY created_at DESC LIMIT 1",
+                (notebook_id, content_hash)
+            ).fetchone()
+        return _public(row) if row else None
+
+    def forget_file(self, notebook_id: str, filename: str):
+        """
+        Called when a file is removed from a notebook: re-uploading it isn't
+        treated as a duplicate, and its queued or running jobs are asked to
+        stop. Workers see the request between page windows (see
+        is_cancel_requested), drop what they indexed and finish as cancelled.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET content_hash = NULL, "
+                "cancel_requested = CASE WHEN status IN ('queued', 'running') THEN 1 ELSE cancel_requested END "
+                "WHERE notebook_id = ? AND json_extract(payload, '$.filename') = ?",
+                (notebook_id, filename)
+            )
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """Takes the oldest queued job whose user is under JOB_MAX_PER_USER running jobs."""
+        self.requeue_stale()
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            row = conn.execute(
+                """
+                SELECT * FROM jobs
+                WHERE status = 'queued'
+                  AND user_id NOT IN (
+                      SELECT user_id FROM jobs WHERE status = 'running'
+                      GROUP BY user_id HAVING COUNT(*) >= ?
+                  )
+                ORDER BY created_at
+                LIMIT 1
+                """,
+                (JOB_MAX_PER_USER,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', stage = 'starting', worker = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ? WHERE id = ?",
+                (worker, now, now, row["id"])
+            )
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def update_progress(self, job_id: str, stage: str, pages_done: Optional[int] = None, pages_total: Optional[int] = None):
+        # Doubles as the heartbeat that keeps a long job from being treated as stale
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET stage = ?, pages_done = COALESCE(?, pages_done), "
+                "pages_total = COALESCE(?, pages_total), heartbeat_at = ? WHERE id = ?",
+                (stage, pages_done, pages_total, time.time(), job_id)
+            )
+
+    def heartbeat(self, job_id: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def finish(self, job_id: str, error: Optional[str] = None, cancelled: bool = False):
+        status = "cancelled" if cancelled else "failed" if error else "succeeded"
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, stage = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, status, error, time.time(), job_id)
+            )
+
+    def requeue_stale(self) -> List[str]:
+        """
+        Running jobs whose worker stopped heartbeating (crash, restart) go back
+        to the queue, or fail once they've used up JOB_MAX_ATTEMPTS.
+        Returns the ids of jobs that failed for good.
+        """
+        cutoff = time.time() - JOB_STALE_AFTER
+        with self._connect(immediate=True) as conn:
+            failed = [r["id"] for r in conn.execute(
+                "SELECT id FROM jobs WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (cutoff, JOB_MAX_ATTEMPTS)
+            )]
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', stage = 'failed', error = 'Worker stopped responding', "
+                "finished_at = ? WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (time.time(), cutoff, JOB_MAX_ATTEMPTS)
+            )
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', stage = 'queued', worker = NULL "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (cutoff,)
+            )
+        return failed
+
+    def get(self, job_id: str, user_id: Optional[str] = None) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (user_id is not None and row["user_id"] != user_id):
+            return None
+        return _public(row)
+
+    def list_for_notebook(self, notebook_id: str, user_id: str, limit: int = 50) -> List[dict]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE notebook_id = ? AND user_id = ? ORDER BY created_at DESC LIMIT ?",
+                (notebook_id, user_id, limit)
+            ).fetchall()
+        return [_public(row) for row in rows]
+
+def _public(row: sqlite3.Row) -> dict:
+    job = {field: row[field] for field in PUBLIC_FIELDS}
+    job["filename"] = json.loads(row["payload"]).get("filename")
+    return job
+
+job_queue = JobQueue()
@@ -0,0 +1,100 @@
+import json
+import time
+import hashlib
+import sqlite3
+from typing import Dict, List, Optional
+
+from app.utils.embedding_cache import normalize_text
+from app.utils.local_db import LocalDB, data_path
+
+# Configuration
+MANIFEST_PATH = data_path("sources.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    notebook_id TEXT NOT NULL,
+    source TEXT NOT NULL,           -- URL, or the file name for uploads
+    chunks TEXT NOT NULL,           -- JSON: {content hash or chunk index: vector id}
+    etag TEXT,
+    last_modified TEXT,
+    updated_at REAL NOT NULL,
+    file_name TEXT,                 -- notebook entry the source is listed under
+    PRIMARY KEY (notebook_id, source)
+);
+"""
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+def chunk_id(notebook_id: str, source: str, content_hash: str) -> str:
+    """Deterministic vector id: the same chunk of the same source always lands on the same id."""
+    return hashlib.sha256(f"{notebook_id}\x00{source}\x00{content_hash}".encode("utf-8")).hexdigest()[:32]
+
+def file_id(notebook_id: str, file_name: str) -> str:
+    """Stable id for a notebook file; its chunks are stored as "<file_id>-<chunk index>"."""
+    return hashlib.sha256(f"{notebook_id}\x00{file_name}".encode("utf-8")).hexdigest()[:16]
+
+def file_chunk_id(file_id: str, index: int) -> str:
+    return f"{file_id}-{index}"
+
+class SourceManifest:
+    """
+    What is indexed for each (notebook, source): the vector id of every chunk
+    (keyed by content hash for URLs, by chunk index for uploaded files), plus
+    HTTP validators (ETag / Last-Modified) for URL sources. Lets re-ingestion
+    diff chunks instead of redoing them, and deleting a file remove exactly
+    its vectors. `file_name` is the entry the source is listed under in the
+    notebook (the filename, or "WEB: ..." for URLs).
+    """
+
+    def __init__(self, path: str = MANIFEST_PATH):
+        self._db = LocalDB(path, SCHEMA, migrate=_migrate)
+
+    def get(self, notebook_id: str, source: str) -> Optional[dict]:
+        """Returns {"chunks": {content_hash: vector_id}, "etag", "last_modified", "file_name"} or None."""
+        with self._db.connect() as conn:
+            row = conn.execute(
+                "SELECT chunks, etag, last_modified, file_name FROM sources WHERE notebook_id = ? AND source = ?",
+                (notebook_id, source)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"chunks": json.loads(row[0]), "etag": row[1], "last_modified": row[2], "file_name": row[3]}
+
+    def save(self, notebook_id: str, source: str, chunks: Dict[str, str], etag: Optional[str] = None, last_modified: Optional[str] = None, file_name: Optional[str] = None):
+        # file_name=None keeps the entry name already recorded for this source
+        with self._db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO sources (notebook_id, source, chunks, etag, last_modified, updated_at, file_name) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (notebook_id, source) DO UPDATE SET chunks = excluded.chunks, etag = excluded.etag, "
+                "last_modified = excluded.last_modified, updated_at = excluded.updated_at, "
+                "file_name = COALESCE(excluded.file_name, sources.file_name)",
+                (notebook_id, source, json.dumps(chunks), etag, last_modified, time.time(), file_name)
+            )
+
+    def find_by_file(self, notebook_id: str, file_name: str) -> Dict[str, List[str]]:
+        """{source: [vector ids]} for every source listed under `file_name` in the notebook."""
+        with self._db.connect() as conn:
+            rows = conn.execute(
+                "SELECT source, chunks FROM sources WHERE notebook_id = ? AND file_name = ?",
+                (notebook_id, file_name)
+            ).fetchall()
+        return {source: list(json.loads(chunks).values()) for source, chunks in rows}
+
+    def delete(self, notebook_id: str, source: str):
+        with self._db.transaction() as conn:
+            conn.execute("DELETE FROM sources WHERE notebook_id = ? AND source = ?", (notebook_id, source))
+
+    def delete_notebook(self, notebook_id: str):
+        with self._db.transaction() as conn:
+            conn.execute("DELETE FROM sources WHERE notebook_id = ?", (notebook_id,))
+
+def _migrate(conn: sqlite3.Connection):
+    # file_name arrived after the first manifests were written
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sources)")}
+    if "file_name" not in columns:
+        conn.execute("ALTER TABLE sources ADD COLUMN file_name TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS sources_file ON sources (notebook_id, file_name)")
+
+source_manifest = SourceManifest()
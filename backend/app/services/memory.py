@@ -0,0 +1,73 @@
+import os
+from typing import Callable, List, Tuple
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+from app.db import (
+    get_recent_messages, get_messages_between,
+    get_conversation_summary, save_conversation_summary
+)
+
+# Configuration
+MEMORY_RECENT_MESSAGES = int(os.getenv("MEMORY_RECENT_MESSAGES", "6"))  # verbatim window (3 turns)
+MEMORY_FOLD_LIMIT = 50         # max messages folded into the summary per update
+MEMORY_SUMMARY_MAX_WORDS = 250
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and Cortex, a research assistant.
+
+CURRENT SUMMARY:
+{summary}
+
+NEW MESSAGES:
+{transcript}
+
+Rewrite the summary so it also covers the new messages. Keep names, numbers, decisions and open questions the user may refer back to. Drop small talk. At most {max_words} words. Return only the summary."""
+
+class ConversationMemory:
+    """
+    Bounded per-notebook chat memory: a rolling summary plus the last
+    MEMORY_RECENT_MESSAGES messages verbatim. Messages that slide out of the
+    window are folded into the summary incrementally, so prompt size stays
+    constant however long the notebook chat gets.
+    """
+
+    def load(self, notebook_id: str, current_message: str) -> Tuple[str, List[BaseMessage]]:
+        """Returns (summary, recent messages) to put ahead of the current question."""
+        state = get_conversation_summary(notebook_id) or {}
+        # +1 because the current question is usually already saved
+        recent = get_recent_messages(notebook_id, MEMORY_RECENT_MESSAGES + 1)
+        if recent and recent[-1]["role"] == "user" and recent[-1]["content"] == current_message:
+            recent = recent[:-1]
+        recent = recent[-MEMORY_RECENT_MESSAGES:]
+
+        history = [
+            HumanMessage(content=m["content"]) if m["role"] == "user" else AIMessage(content=m["content"])
+            for m in recent
+        ]
+        return state.get("summary") or "", history
+
+    def update(self, notebook_id: str, summarize: Callable[[str], str]):
+        """Folds messages that left the verbatim window into the summary. Run after each turn."""
+        recent = get_recent_messages(notebook_id, MEMORY_RECENT_MESSAGES)
+        if len(recent) < MEMORY_RECENT_MESSAGES:
+            return  # everything still fits verbatim
+
+        state = get_conversation_summary(notebook_id) or {}
+        to_fold = get_messages_between(
+            notebook_id,
+            after=state.get("summarized_until"),
+            before=recent[0]["created_at"],
+            limit=MEMORY_FOLD_LIMIT
+        )
+        if not to_fold:
+            return
+
+        transcript = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in to_fold)
+        prompt = SUMMARY_PROMPT.format(
+            summary=state.get("summary") or "(empty)",
+            transcript=transcript,
+            max_words=MEMORY_SUMMARY_MAX_WORDS
+        )
+        summary = summarize(prompt)
+        save_conversation_summary(notebook_id, summary.strip(), to_fold[-1]["created_at"])
+
+conversation_memory = ConversationMemory()
@@ -1,41 +1,109 @@
 import os
 import json
+import asyncio
+import random
+import hashlib
+from functools import lru_cache
 from typing import TypedDict, Annotated, List
 from dotenv import load_dotenv
 
 # LangChain / Google Imports
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 
 # Agent Imports
 from langchain_community.tools.tavily_search import TavilySearchResults
 from langgraph.graph import StateGraph, END, add_messages
 from langgraph.prebuilt import ToolNode
 
+from app.services.vector_store import get_vector_store
+from app.utils.answer_cache import answer_cache
+from app.utils.embedding_cache import CachedEmbeddings
+from app.utils.keyword_index import keyword_index, reciprocal_rank_fusion
+from app.utils.search_cache import CachedSearchTool
+from app.utils.context_packer import pack_context
+from app.services.memory import conversation_memory
+from app.utils.metrics import stage
+from app.utils.rate_controller import is_rate_limited
+
 load_dotenv()
 
-PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Chunks that reach the context packer; the token budget, not k, bounds the prompt
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "8"))
+HYBRID_CANDIDATES = max(10, RETRIEVAL_K)  # candidates pulled from each retriever before fusion
+# Below this top dense cosine score the PDF almost never has the answer, so we
+# fetch web results up front instead of paying an LLM round to decide to search
+WEB_SEARCH_SCORE_THRESHOLD = float(os.getenv("WEB_SEARCH_SCORE_THRESHOLD", "0.5"))
+# "off" | "low_score" (search after weak retrieval) | "eager" (async paths start
+# the search concurrently with retrieval and keep it only if retrieval is weak)
+SPECULATIVE_WEB_SEARCH = os.getenv("SPECULATIVE_WEB_SEARCH", "low_score")
+# chat_batch(): generations in flight at once, and retries for Gemini 429s
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "4"))
+BATCH_BACKOFF_BASE = 2.0   # seconds; doubles per retry, with jitter
+BATCH_BACKOFF_MAX = 30.0
 
 # 1. Define Agent State 
 class AgentState(TypedDict):
     messages: Annotated[List[BaseMessage], add_messages]
 
+# 2. Define the Agent Graph (compiled once per process)
+# Nothing per-request is closed over here: the tool-bound LLM for the current
+# user is passed in through config["configurable"]["llm"] on every invoke.
+@lru_cache(maxsize=1)
+def get_search_tool():
+    # TTL-cached and single-flight: identical concurrent searches share one call
+    return CachedSearchTool(TavilySearchResults(max_results=3))
+
+def reasoner(state: AgentState, config: RunnableConfig):
+    # INVOKE LLM (passing config through keeps callbacks/streaming attached)
+    llm_with_tools = config["configurable"]["llm"]
+    with stage("gemini.chat"):
+        response = llm_with_tools.invoke(state['messages'], config)
+    return {"messages": [response]}
+
+async def areasoner(state: AgentState, config: RunnableConfig):
+    # Async twin used by ainvoke/astream so the event loop is never blocked
+    llm_with_tools = config["configurable"]["llm"]
+    with stage("gemini.chat"):
+        response = await llm_with_tools.ainvoke(state['messages'], config)
+    return {"messages": [response]}
+
+def should_continue(state: AgentState):
+    last_message = state['messages'][-1]
+    if last_message.tool_calls:
+        return "tools"
+    return END
+
+def build_agent_graph(tools: List):
+    workflow = StateGraph(AgentState)
+
+    workflow.add_node("agent", RunnableLambda(reasoner, afunc=areasoner, name="agent"))
+    workflow.add_node("tools", ToolNode(tools))
+
+    workflow.set_entry_point("agent")
+    workflow.add_conditional_edges("agent", should_continue)
+    workflow.add_edge("tools", "agent")
+
+    return workflow.compile()
+
+@lru_cache(maxsize=1)
+def get_agent_graph():
+    return build_agent_graph([get_search_tool()])
+
 class RagService:
     def __init__(self, google_api_key: str):
-        # Embeddings
-        self.embeddings = GoogleGenerativeAIEmbeddings(
+        # Embeddings (query vectors are cached in memory / Redis)
+        self.embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(
             model="models/gemini-embedding-001", 
             google_api_key=google_api_key
-        )
+        ))
         
-        # Vector Store
-        self.vectorstore = PineconeVectorStore(
-            index_name=PINECONE_INDEX_NAME,
-            embedding=self.embeddings
-        )
+        # Vector Store (Pinecone or local, per VECTOR_STORE_BACKEND)
+        self.vector_store = get_vector_store()
         
         # LLM (Back to YOUR chosen model)
         self.llm = ChatGoogleGenerativeAI(
@@ -44,26 +112,116 @@ class RagService:
             google_api_key=google_api_key
         )
 
-        # Tools
-        self.search_tool = TavilySearchResults(max_results=3)
+        # Tools (shared with the compiled graph's ToolNode)
+        self.search_tool = get_search_tool()
+        self.llm_with_tools = self.llm.bind_tools([self.search_tool])
+
+    def close(self):
+        # Release the Gemini HTTP clients (called when the service pool evicts us).
+        # achat/stream_chat go through the async client, so it is closed too.
+        for model in (self.llm, self.embeddings.embeddings):
+            client = getattr(model, "client", None)
+            if client is not None and hasattr(client, "close"):
+                client.close()
+            aio = getattr(client, "aio", None)
+            if aio is not None and hasattr(aio, "aclose"):
+                _run_aclose(aio)
 
-    def chat(self, message: str, notebook_id: str):
-        # A. RETRIEVE PDF CONTEXT
-        retriever = self.vectorstore.as_retriever(
-            search_kwargs={"k": 3, "namespace": notebook_id}
+    # The query is embedded once and that vector drives both the answer cache
+    # lookup and the Pinecone query. Dense hits are fused with BM25 keyword hits
+    # so exact terms (part numbers, names, acronyms) aren't missed.
+    # `file_names` restricts both to chunks of those notebook files.
+    # Returns (docs, top dense score).
+    def _retrieve(self, message: str, query_vector: List[float], notebook_id: str, file_names: List[str] = None):
+        dense_hits = self.vector_store.query(notebook_id, query_vector, HYBRID_CANDIDATES, _file_filter(file_names))
+        with stage("bm25.search"):
+            sparse_hits = keyword_index.search(notebook_id, message, HYBRID_CANDIDATES, file_names)
+        return self._fuse(dense_hits, sparse_hits)
+
+    async def _aretrieve(self, message: str, query_vector: List[float], notebook_id: str, file_names: List[str] = None):
+        dense_hits, sparse_hits = await asyncio.gather(
+            self.vector_store.aquery(notebook_id, query_vector, HYBRID_CANDIDATES, _file_filter(file_names)),
+            asyncio.to_thread(keyword_index.search, notebook_id, message, HYBRID_CANDIDATES, file_names)
         )
-        docs = retriever.invoke(message)
-        context_text = "\n\n".join([d.page_content for d in docs])
-        
+        return self._fuse(dense_hits, sparse_hits)
+
+    def _fuse(self, dense_hits, sparse_hits):
+        dense_docs = [doc for doc, _ in dense_hits]
+        sparse_docs = [doc for doc, _ in sparse_hits]
+        top_score = dense_hits[0][1] if dense_hits else 0.0
+        return reciprocal_rank_fusion([dense_docs, sparse_docs])[:RETRIEVAL_K], top_score
+
+    def _needs_web(self, top_score: float) -> bool:
+        return SPECULATIVE_WEB_SEARCH != "off" and top_score < WEB_SEARCH_SCORE_THRESHOLD
+
+    # Speculative web search: results go straight into the prompt. None on failure,
+    # in which case the agent keeps its tool and can still search on its own.
+    def _search_web(self, message: str):
+        content, _ = self.search_tool._run(message)
+        return content if isinstance(content, list) else None
+
+    async def _asearch_web(self, message: str):
+        content, _ = await self.search_tool._arun(message)
+        return content if isinstance(content, list) else None
+
+    def _start_eager_search(self, message: str):
+        if SPECULATIVE_WEB_SEARCH != "eager":
+            return None
+        task = asyncio.create_task(self._asearch_web(message))
+        # If retrieval turns out strong nobody awaits this; the result still lands in the search cache
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    # --- Conversation memory (rolling summary + last few turns) ---
+    def _load_memory(self, notebook_id: str, message: str, use_memory: bool):
+        if not use_memory:
+            return "", []
+        return conversation_memory.load(notebook_id, message)
+
+    async def _aload_memory(self, notebook_id: str, message: str, use_memory: bool):
+        if not use_memory:
+            return "", []
+        return await asyncio.to_thread(conversation_memory.load, notebook_id, message)
+
+    def _context_key(self, history: List):
+        # Follow-ups are answered relative to the previous answer; see SemanticAnswerCache
+        if not history:
+            return None
+        return hashlib.sha256(content_to_text(history[-1].content).encode("utf-8")).hexdigest()
+
+    def update_memory(self, notebook_id: str):
+        """Folds turns that left the verbatim window into the notebook's summary."""
+        with stage("memory.update"):
+            conversation_memory.update(
+                notebook_id,
+                lambda prompt: content_to_text(self.llm.invoke([HumanMessage(content=prompt)]).content)
+            )
+
+    def _build_inputs(self, message: str, context_text: str, web_results: List = None, summary: str = "", history: List = None):
         if not context_text:
             context_text = "No PDF context found."
 
-        # B. SETUP TOOLS
-        tools = [self.search_tool]
-        llm_with_tools = self.llm.bind_tools(tools)
+        memory_text = f"""
+        CONVERSATION SUMMARY (earlier turns):
+        {summary}
+        """ if summary else ""
 
-        # C. SYSTEM PROMPT
-        system_msg = f"""You are Cortex.
+        if web_results is not None:
+            web_text = "\n\n".join(f"[{r.get('url', '')}]\n{r.get('content', '')}" for r in web_results) or "No web results found."
+            system_msg = f"""You are Cortex.
+        
+        PDF CONTEXT:
+        {context_text}
+        
+        WEB SEARCH RESULTS:
+        {web_text}
+        
+        Answer using the PDF context where it applies, otherwise the web results.
+        {memory_text}
+        Current Question: {message}
+        """
+        else:
+            system_msg = f"""You are Cortex.
         
         STEP 1: Check PDF CONTEXT:
         {context_text}
@@ -71,74 +229,251 @@ class RagService:
         STEP 2: Answer.
         - If context has the answer, use it.
         - If NOT, use 'tavily_search_results_json' to search the web.
-        
+        {memory_text}
         Current Question: {message}
         """
 
-        # D. BUILD GRAPH
-        workflow = StateGraph(AgentState)
-
-        def reasoner(state):
-            # INVOKE LLM
-            response = llm_with_tools.invoke(state['messages'])
-            return {"messages": [response]}
-
-        workflow.add_node("agent", reasoner)
-        workflow.add_node("tools", ToolNode(tools))
-
-        def should_continue(state):
-            last_message = state['messages'][-1]
-            if last_message.tool_calls:
-                return "tools"
-            return END
-
-        workflow.set_entry_point("agent")
-        workflow.add_conditional_edges("agent", should_continue)
-        workflow.add_edge("tools", "agent")
-
-        app = workflow.compile()
-
-        # E. RUN
-        inputs = {
+        return {
             "messages": [
                 SystemMessage(content=system_msg),
+                *(history or []),
                 HumanMessage(content=message)
             ]
         }
-        
-        result = app.invoke(inputs)
 
-        # F. FORMAT OUTPUT
+    def _graph_config(self, notebook_id: str, use_tools: bool = True):
+        # The graph is compiled once; this request's LLM rides in config.
+        # With web results already in the prompt the plain LLM answers in one round.
+        llm = self.llm_with_tools if use_tools else self.llm
+        return {"configurable": {"llm": llm, "notebook_id": notebook_id}}
+
+    def _final_answer(self, result) -> str:
         last_message = result["messages"][-1]
-        raw_content = last_message.content
-        
-        final_msg = ""
-        
-        # 🛡️ FIX: specific parsing for Gemini 2.5 Multi-part responses
-        if isinstance(raw_content, str):
-            final_msg = raw_content
-        elif isinstance(raw_content, list):
-            # If it's a list, extract the 'text' from each part
-            parts = []
-            for part in raw_content:
-                if isinstance(part, dict) and "text" in part:
-                    parts.append(part["text"])  # <--- This fixes your issue
-                elif isinstance(part, str):
-                    parts.append(part)
-                else:
-                    parts.append(str(part))
-            final_msg = " ".join(parts)
-        else:
-            # Fallback for any other weird types
-            final_msg = str(raw_content)
+        final_msg = content_to_text(last_message.content)
 
         # Handle case where Agent returns empty content but has tool calls
         if not final_msg.strip() and last_message.tool_calls:
              final_msg = "Searching the web..."
+        return final_msg
+
+    def chat(self, message: str, notebook_id: str, use_memory: bool = False, file_names: List[str] = None):
+        # A. CHECK ANSWER CACHE (near-identical question on the same notebook)
+        # Answers restricted to some files aren't cached: they'd match unrestricted questions
+        summary, history = self._load_memory(notebook_id, message, use_memory)
+        context_key = self._context_key(history)
+        query_vector = self.embeddings.embed_query(message)
+        if not file_names:
+            cached, generation = answer_cache.lookup(notebook_id, query_vector, context_key)
+            if cached:
+                return cached
+
+        # B. RETRIEVE PDF CONTEXT (+ web results up front if retrieval is weak)
+        docs, top_score = self._retrieve(message, query_vector, notebook_id, file_names)
+        with stage("context.pack"):
+            context_text, docs = pack_context(docs)
+        web_results = self._search_web(message) if self._needs_web(top_score) else None
+
+        # C. SYSTEM PROMPT
+        inputs = self._build_inputs(message, context_text, web_results, summary, history)
+
+        # D. RUN
+        result = get_agent_graph().invoke(inputs, config=self._graph_config(notebook_id, use_tools=web_results is None))
+
+        # E. FORMAT OUTPUT
+        response = {"answer": self._final_answer(result), "sources": format_sources(docs)}
+        if not file_names:
+            answer_cache.store(notebook_id, query_vector, response, generation, context_key)
+        return response
+
+    async def achat(self, message: str, notebook_id: str, use_memory: bool = False, file_names: List[str] = None):
+        """Async version of chat(): retrieval and every graph step are awaited."""
+        query_vector, (summary, history) = await asyncio.gather(
+            self.embeddings.aembed_query(message),
+            self._aload_memory(notebook_id, message, use_memory)
+        )
+        return await self._aanswer(message, query_vector, notebook_id, summary, history, file_names=file_names)
+
+    async def _aanswer(self, message: str, query_vector: List[float], notebook_id: str, summary: str = "", history: List = None, run_graph=None, file_names: List[str] = None):
+        # Shared by achat() and chat_batch(); run_graph lets the batch path
+        # throttle and retry the generation without touching retrieval
+        context_key = self._context_key(history)
+        if not file_names:
+            cached, generation = await asyncio.to_thread(answer_cache.lookup, notebook_id, query_vector, context_key)
+            if cached:
+                return cached
+
+        eager_search = self._start_eager_search(message)
+        docs, top_score = await self._aretrieve(message, query_vector, notebook_id, file_names)
+        with stage("context.pack"):
+            context_text, docs = pack_context(docs)
+        web_results = None
+        if self._needs_web(top_score):
+            web_results = await (eager_search or self._asearch_web(message))
+
+        inputs = self._build_inputs(message, context_text, web_results, summary, history)
+        config = self._graph_config(notebook_id, use_tools=web_results is None)
+        if run_graph is None:
+            result = await get_agent_graph().ainvoke(inputs, config=config)
+        else:
+            result = await run_graph(inputs, config)
+
+        response = {"answer": self._final_answer(result), "sources": format_sources(docs)}
+        if not file_names:
+            await asyncio.to_thread(answer_cache.store, notebook_id, query_vector, response, generation, context_key)
+        return response
+
+    async def chat_batch(self, messages: List[str], notebook_id: str, concurrency: int = BATCH_CONCURRENCY):
+        """
+        Answers independent questions against one notebook (evaluation, bulk Q&A).
+        All questions are embedded in one batched call, retrieval runs for every
+        question at once, and at most `concurrency` generations are in flight,
+        each retried with exponential backoff when Gemini rate-limits us.
+        Conversation memory is not used. Returns one entry per question, in
+        order: {"answer", "sources"} or {"error": "..."}.
+        """
+        if not messages:
+            return []
+        try:
+            query_vectors = await _with_backoff(lambda: self.embeddings.aembed_queries(messages))
+        except Exception as e:
+            return [{"error": str(e)} for _ in messages]
+
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run_graph(inputs, config):
+            async with slots:
+                return await _with_backoff(lambda: get_agent_graph().ainvoke(inputs, config=config))
+
+        results = await asyncio.gather(
+            *(self._aanswer(message, vector, notebook_id, run_graph=run_graph)
+              for message, vector in zip(messages, query_vectors)),
+            return_exceptions=True
+        )
+        return [{"error": str(r)} if isinstance(r, Exception) else r for r in results]
+
+    async def stream_chat(self, message: str, notebook_id: str, use_memory: bool = False, file_names: List[str] = None):
+        """
+        Async generator of chat events for Server-Sent Events:
+        - {"event": "sources", "data": [...]}        retrieved PDF sources (sent first)
+        - {"event": "tool", "data": {...}}           the agent called a tool (e.g. web search)
+        - {"event": "token", "data": "..."}          answer text as Gemini produces it
+        - {"event": "done", "data": {answer, sources}} the final answer
+        Tokens emitted before a "tool" event belong to an intermediate step, so
+        clients should reset their answer buffer when a tool event arrives.
+        """
+        query_vector, (summary, history) = await asyncio.gather(
+            self.embeddings.aembed_query(message),
+            self._aload_memory(notebook_id, message, use_memory)
+        )
+        context_key = self._context_key(history)
+        if not file_names:
+            cached, generation = await asyncio.to_thread(answer_cache.lookup, notebook_id, query_vector, context_key)
+            if cached:
+                yield {"event": "sources", "data": cached["sources"]}
+                yield {"event": "token", "data": cached["answer"]}
+                yield {"event": "done", "data": cached}
+                return
+
+        eager_search = self._start_eager_search(message)
+        docs, top_score = await self._aretrieve(message, query_vector, notebook_id, file_names)
+        with stage("context.pack"):
+            context_text, docs = pack_context(docs)
+        sources = format_sources(docs)
+        yield {"event": "sources", "data": sources}
+
+        web_results = None
+        if self._needs_web(top_score):
+            yield {"event": "tool", "data": {"name": self.search_tool.name, "status": TOOL_STATUS[self.search_tool.name], "args": {"query": message}}}
+            web_results = await (eager_search or self._asearch_web(message))
+
+        inputs = self._build_inputs(message, context_text, web_results, summary, history)
+        answer_parts = []
+
+        async for mode, payload in get_agent_graph().astream(
+            inputs,
+            config=self._graph_config(notebook_id, use_tools=web_results is None),
+            stream_mode=["messages", "updates"]
+        ):
+            if mode == "messages":
+                chunk, metadata = payload
+                if metadata.get("langgraph_node") != "agent":
+                    continue
+                token = content_to_text(chunk.content, separator="")
+                if token:
+                    answer_parts.append(token)
+                    yield {"event": "token", "data": token}
+            elif mode == "updates" and "agent" in payload:
+                last_message = payload["agent"]["messages"][-1]
+                for tool_call in last_message.tool_calls or []:
+                    answer_parts = []
+                    yield {
+                        "event": "tool",
+                        "data": {
+                            "name": tool_call["name"],
+                            "status": TOOL_STATUS.get(tool_call["name"], "Running a tool..."),
+                            "args": tool_call.get("args", {})
+                        }
+                    }
+
+        response = {"answer": "".join(answer_parts), "sources": sources}
+        if not file_names:
+            await asyncio.to_thread(answer_cache.store, notebook_id, query_vector, response, generation, context_key)
+        yield {"event": "done", "data": response}
+
+def _run_aclose(aio_client):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Pool evictions happen in threadpool threads, which have no loop
+        asyncio.run(aio_client.aclose())
+    else:
+        loop.create_task(aio_client.aclose())
+
+async def _with_backoff(call, retries: int = BATCH_MAX_RETRIES):
+    """Awaits call(), retrying rate-limit errors with jittered exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == retries or not is_rate_limited(e):
+                raise
+            delay = min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * 2 ** attempt)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+# Progress labels shown to the user while a tool runs
+TOOL_STATUS = {
+    "tavily_search_results_json": "Searching the web...",
+}
+
+def _file_filter(file_names: List[str]):
+    # Pinecone metadata filter; chunks of uploaded files carry metadata["file_name"]
+    return {"file_name": {"$in": list(file_names)}} if file_names else None
 
-        sources = [
-            {"source": doc.metadata.get("source", "Unknown"), "page": doc.metadata.get("page", 1)} 
-            for doc in docs
-        ]
+def content_to_text(raw_content, separator: str = " ") -> str:
+    # 🛡️ FIX: specific parsing for Gemini 2.5 Multi-part responses
+    if isinstance(raw_content, str):
+        return raw_content
+    if isinstance(raw_content, list):
+        # If it's a list, extract the 'text' from each part
+        parts = []
+        for part in raw_content:
+            if isinstance(part, dict) and "text" in part:
+                parts.append(part["text"])  # <--- This fixes your issue
+            elif isinstance(part, str):
+                parts.append(part)
+            else:
+                parts.append(str(part))
+        return separator.join(parts)
+    # Fallback for any other weird types
+    return str(raw_content)
 
-        return {"answer": final_msg, "sources": sources}
\ No newline at end of file
+def format_sources(docs: List):
+    # Merged segments carry every doc they span, so one page can appear many
+    # times; the UI draws a chip per entry. Keep the first (best-ranked) one.
+    sources, seen = [], set()
+    for doc in docs:
+        key = (doc.metadata.get("source", "Unknown"), doc.metadata.get("page", 1))
+        if key not in seen:
+            seen.add(key)
+            sources.append({"source": key[0], "page": key[1]})
+    return sources
@@ -0,0 +1,148 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, TypeVar
+
+from app.services.ingestion import IngestionService
+from app.services.rag import RagService
+
+T = TypeVar("T")
+
+# Configuration
+SERVICE_POOL_MAX_SIZE = int(os.getenv("SERVICE_POOL_MAX_SIZE", "32"))
+SERVICE_POOL_IDLE_TTL = int(os.getenv("SERVICE_POOL_IDLE_TTL", "900"))  # seconds
+# Evicted services stay open this long, so requests and background tasks
+# (e.g. the post-chat memory update) still holding them can finish
+SERVICE_CLOSE_GRACE = int(os.getenv("SERVICE_CLOSE_GRACE", "300"))  # seconds
+
+def hash_api_key(api_key: str) -> str:
+    """Keys are never stored in plaintext as dict keys; we index by their SHA-256."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+class ServiceRegistry(Generic[T]):
+    """
+    Bounded pool of per-API-key service instances.
+    Entries are evicted least-recently-used first once the pool is full, and
+    whenever they sit idle for longer than `idle_ttl` seconds. Evicted services
+    get their `close()` called so their HTTP clients are released, but only
+    `close_grace` seconds later: callers don't hand services back, so one may
+    still be in use when it leaves the pool.
+    """
+
+    def __init__(self, factory: Callable[[str], T], max_size: int = SERVICE_POOL_MAX_SIZE, idle_ttl: int = SERVICE_POOL_IDLE_TTL, close_grace: int = SERVICE_CLOSE_GRACE):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.close_grace = close_grace
+        self._entries: "OrderedDict[str, list]" = OrderedDict()  # key_hash -> [service, last_used]
+        self._retiring: list = []  # [(service, evicted_at)], oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, api_key: str) -> T:
+        key_hash = hash_api_key(api_key)
+        now = time.monotonic()
+
+        with self._lock:
+            due = self._retire(self._evict_idle(now), now)
+            entry = self._entries.get(key_hash)
+            if entry:
+                entry[1] = now
+                self._entries.move_to_end(key_hash)
+                self.hits += 1
+                service = entry[0]
+            else:
+                self.misses += 1
+                service = None
+        self._close_all(due)
+
+        if service is not None:
+            return service
+
+        # Build outside the lock: client setup is slow and must not block other keys
+        service = self.factory(api_key)
+
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry:
+                # Another request won the race; keep theirs and drop ours (nobody else has it)
+                due = [service]
+                service = entry[0]
+                entry[1] = now
+                self._entries.move_to_end(key_hash)
+            else:
+                self._entries[key_hash] = [service, now]
+                evicted = []
+                while len(self._entries) > self.max_size:
+                    _, (old_service, _) = self._entries.popitem(last=False)
+                    self.evictions += 1
+                    evicted.append(old_service)
+                due = self._retire(evicted, now)
+        self._close_all(due)
+
+        return service
+
+    def _evict_idle(self, now: float) -> list:
+        # OrderedDict is in LRU order, so idle entries are always at the front
+        evicted = []
+        while self._entries:
+            key_hash, (service, last_used) = next(iter(self._entries.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            del self._entries[key_hash]
+            self.evictions += 1
+            evicted.append(service)
+        return evicted
+
+    def _retire(self, evicted: list, now: float) -> list:
+        """Queues evicted services; returns those whose grace period is over. Caller holds the lock."""
+        self._retiring.extend((service, now) for service in evicted)
+        due = []
+        while self._retiring and now - self._retiring[0][1] >= self.close_grace:
+            due.append(self._retiring.pop(0)[0])
+        return due
+
+    def _close_all(self, services: list):
+        for service in services:
+            close = getattr(service, "close", None)
+            if not close:
+                continue
+            try:
+                close()
+            except Exception as e:
+                print(f"Service cleanup failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            services = [service for service, _ in self._entries.values()]
+            services += [service for service, _ in self._retiring]
+            self._entries.clear()
+            self._retiring.clear()
+        self._close_all(services)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "retiring": len(self._retiring),
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+# Process-wide pools used by the API layer
+rag_services: ServiceRegistry[RagService] = ServiceRegistry(RagService)
+ingestion_services: ServiceRegistry[IngestionService] = ServiceRegistry(IngestionService)
+
+def get_registry_stats() -> dict:
+    return {
+        "rag": rag_services.stats(),
+        "ingestion": ingestion_services.stats(),
+    }
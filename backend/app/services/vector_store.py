@@ -0,0 +1,340 @@
+import os
+import re
+import json
+import uuid
+import shutil
+import asyncio
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import NotFoundException
+from app.utils.metrics import stage, timed
+from app.utils.local_db import data_path, file_lock
+
+load_dotenv()
+
+# Configuration
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone")  # "pinecone" | "local"
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
+EMBEDDING_DIMENSION = 3072
+LOCAL_VECTOR_DIR = data_path("vectors")
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float32")  # "float32" | "float16"
+
+# Pinecone caps request size at 2MB; 100 x 3072 float32s stays well under it
+UPSERT_BATCH_SIZE = 100
+# Connection pool of the shared data-plane Index handle
+PINECONE_POOL_THREADS = int(os.getenv("PINECONE_POOL_THREADS", "8"))
+
+ScoredDocs = List[Tuple[Document, float]]
+
+class VectorStore:
+    """
+    Minimal vector-store interface used by ingestion and retrieval.
+    Vectors are computed by the caller, so every backend stores exactly what
+    the embedding pipeline produced. Scores are cosine similarity (higher is better).
+    """
+
+    def upsert(self, namespace: str, vectors: List[List[float]], docs: List[Document], ids: Optional[List[str]] = None) -> List[str]:
+        raise NotImplementedError
+
+    def query(self, namespace: str, vector: List[float], k: int, filter: Optional[dict] = None) -> ScoredDocs:
+        raise NotImplementedError
+
+    async def aquery(self, namespace: str, vector: List[float], k: int, filter: Optional[dict] = None) -> ScoredDocs:
+        return await asyncio.to_thread(self.query, namespace, vector, k, filter)
+
+    def delete(self, namespace: str, ids: List[str]):
+        raise NotImplementedError
+
+    def delete_namespace(self, namespace: str):
+        raise NotImplementedError
+
+    def ensure_ready(self):
+        """Creates whatever the backend needs before the first upsert."""
+
+# --- Pinecone (serverless, default) ---
+class PineconeVectorStoreBackend(VectorStore):
+    """
+    One per process (see get_vector_store): the index is verified or created
+    once, at startup or on first use, and a single data-plane Index handle
+    with a pooled HTTP connection serves ingestion, retrieval and deletion.
+    The control plane is only consulted again if a call shows the index is gone.
+    """
+
+    def __init__(self, api_key: str = PINECONE_API_KEY, index_name: str = PINECONE_INDEX_NAME):
+        self.pc = Pinecone(api_key=api_key, pool_threads=PINECONE_POOL_THREADS)
+        self.index_name = index_name
+        self._index = None
+        self._ready = False
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    # Resolves the index host once (a describe_index call)
+                    self._index = self.pc.Index(self.index_name)
+        return self._index
+
+    def ensure_ready(self):
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            # Ensure Index
+            with stage("pinecone.ensure_ready"):
+                existing_indexes = [index.name for index in self.pc.list_indexes()]
+                if self.index_name not in existing_indexes:
+                    self.pc.create_index(
+                        name=self.index_name,
+                        dimension=EMBEDDING_DIMENSION,
+                        metric="cosine",
+                        spec=ServerlessSpec(cloud="aws", region="us-east-1")
+                    )
+            self._ready = True
+
+    def _call(self, operation):
+        """Runs operation(index); if the index has disappeared, re-validates once and retries."""
+        try:
+            return operation(self.index)
+        except Exception as e:
+            if not _index_gone(e):
+                raise
+            print(f"Pinecone index '{self.index_name}' looks gone ({e}); re-validating")
+            with self._lock:
+                self._ready = False
+                self._index = None
+            self.ensure_ready()
+            return operation(self.index)
+
+    @timed("pinecone.upsert")
+    def upsert(self, namespace, vectors, docs, ids=None):
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        records = [
+            # Same layout langchain_pinecone uses: chunk text lives in metadata["text"]
+            {"id": id_, "values": vector, "metadata": {**doc.metadata, "text": doc.page_content}}
+            for id_, vector, doc in zip(ids, vectors, docs)
+        ]
+        for start in range(0, len(records), UPSERT_BATCH_SIZE):
+            batch = records[start:start + UPSERT_BATCH_SIZE]
+            self._call(lambda index: index.upsert(vectors=batch, namespace=namespace))
+        return ids
+
+    @timed("pinecone.query")
+    def query(self, namespace, vector, k, filter=None):
+        response = self._call(lambda index: index.query(
+            vector=vector, top_k=k, namespace=namespace, include_metadata=True, filter=filter
+        ))
+        results = []
+        for match in response.matches:
+            metadata = dict(match.metadata or {})
+            text = metadata.pop("text", "")
+            results.append((Document(id=match.id, page_content=text, metadata=metadata), match.score))
+        return results
+
+    @timed("pinecone.delete")
+    def delete(self, namespace, ids):
+        for start in range(0, len(ids), 1000):
+            batch = ids[start:start + 1000]
+            self._call(lambda index: index.delete(ids=batch, namespace=namespace))
+
+    @timed("pinecone.delete_namespace")
+    def delete_namespace(self, namespace):
+        self._call(lambda index: index.delete(delete_all=True, namespace=namespace))
+
+def _index_gone(error: Exception) -> bool:
+    # A 404 for a missing namespace is normal; one for the index, or a host
+    # that no longer resolves, means the index was deleted or recreated
+    message = str(error)
+    if isinstance(error, NotFoundException):
+        return "namespace" not in message.lower()
+    return "Failed to resolve" in message
+
+# --- Local (in-process, memory-mapped) ---
+class _LocalNamespace:
+    """Snapshot of one namespace: memory-mapped matrix + metadata sidecar."""
+
+    def __init__(self, matrix: np.ndarray, rows: List[dict], live: np.ndarray, size_key: tuple):
+        self.matrix = matrix
+        self.rows = rows
+        self.live = live
+        self.size_key = size_key
+
+class LocalVectorStoreBackend(VectorStore):
+    """
+    In-process backend for local development and benchmarking.
+    Each namespace is a directory holding:
+    - vectors.bin   append-only matrix of unit-normalized float32/float16 rows
+    - meta.jsonl    one {"id", "text", "metadata"} line per row
+    - deleted.jsonl tombstones: [id, rows in the matrix when it was deleted]
+    Queries are a single vectorized NumPy dot product over the memory-mapped
+    matrix. Re-upserting an id appends a new row that supersedes the old one,
+    including one deleted earlier (ids are deterministic, so files re-use them).
+    """
+
+    def __init__(self, root: str = LOCAL_VECTOR_DIR, dtype: str = LOCAL_VECTOR_DTYPE):
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self._cache: Dict[str, _LocalNamespace] = {}
+        self._lock = threading.Lock()
+
+    def _dir(self, namespace: str) -> str:
+        return os.path.join(self.root, re.sub(r"[^\w-]", "_", namespace))
+
+    def _paths(self, namespace: str):
+        base = self._dir(namespace)
+        return (os.path.join(base, "vectors.bin"), os.path.join(base, "meta.jsonl"), os.path.join(base, "deleted.jsonl"))
+
+    @contextmanager
+    def _write_lock(self, namespace: str):
+        """
+        Serializes writers of one namespace across threads and processes: the
+        API process (URL ingestion) and ingestion workers can append to the
+        same namespace, and interleaved appends would pair vectors with the
+        wrong metadata rows. Caller creates the namespace directory first.
+        """
+        with self._lock, file_lock(os.path.join(self._dir(namespace), ".lock")):
+            yield
+
+    @timed("local_vectors.upsert")
+    def upsert(self, namespace, vectors, docs, ids=None):
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = (matrix / np.where(norms == 0, 1, norms)).astype(self.dtype)
+
+        vec_path, meta_path, _ = self._paths(namespace)
+        os.makedirs(self._dir(namespace), exist_ok=True)
+        with self._write_lock(namespace):
+            # Vectors first: a crash between the two writes leaves orphan rows
+            # that _load ignores, never metadata pointing past the matrix
+            with open(vec_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(meta_path, "a", encoding="utf-8") as f:
+                for id_, doc in zip(ids, docs):
+                    f.write(json.dumps({"id": id_, "text": doc.page_content, "metadata": doc.metadata}, default=str) + "\n")
+            self._cache.pop(namespace, None)
+        return ids
+
+    def _load(self, namespace: str) -> Optional[_LocalNamespace]:
+        vec_path, meta_path, deleted_path = self._paths(namespace)
+        if not os.path.exists(vec_path) or not os.path.exists(meta_path):
+            return None
+        size_key = tuple(os.path.getsize(p) if os.path.exists(p) else 0 for p in (vec_path, meta_path, deleted_path))
+
+        with self._lock:
+            cached = self._cache.get(namespace)
+            if cached and cached.size_key == size_key:
+                return cached
+
+            with open(meta_path, encoding="utf-8") as f:
+                # Skip a trailing line another process is still writing
+                rows = [json.loads(line) for line in f if line.endswith("\n")]
+            deleted = {}  # id -> rows written before its latest tombstone
+            if os.path.exists(deleted_path):
+                with open(deleted_path, encoding="utf-8") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        # Older tombstones are bare ids and hide every row of that id
+                        id_, before = entry if isinstance(entry, list) else (entry, float("inf"))
+                        deleted[id_] = max(deleted.get(id_, 0), before)
+
+            n_rows = min(len(rows), size_key[0] // (self.dtype.itemsize * EMBEDDING_DIMENSION))
+            rows = rows[:n_rows]
+            if n_rows == 0:
+                return None
+            matrix = np.memmap(vec_path, dtype=self.dtype, mode="r", shape=(n_rows, EMBEDDING_DIMENSION))
+
+            # Latest row per id wins; tombstoned ids are masked out
+            live = np.zeros(n_rows, dtype=bool)
+            latest = {}
+            for i, row in enumerate(rows):
+                latest[row["id"]] = i
+            for id_, i in latest.items():
+                if i >= deleted.get(id_, 0):
+                    live[i] = True
+
+            snapshot = _LocalNamespace(matrix, rows, live, size_key)
+            self._cache[namespace] = snapshot
+            return snapshot
+
+    @timed("local_vectors.query")
+    def query(self, namespace, vector, k, filter=None):
+        snapshot = self._load(namespace)
+        if snapshot is None:
+            return []
+
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        mask = snapshot.live
+        if filter:
+            mask = mask & np.array([_matches(row["metadata"], filter) for row in snapshot.rows])
+        candidates = np.flatnonzero(mask)
+        if candidates.size == 0:
+            return []
+
+        scores = snapshot.matrix[candidates].astype(np.float32) @ query
+        k = min(k, candidates.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for i in top:
+            row = snapshot.rows[candidates[i]]
+            results.append((Document(id=row["id"], page_content=row["text"], metadata=row["metadata"]), float(scores[i])))
+        return results
+
+    @timed("local_vectors.delete")
+    def delete(self, namespace, ids):
+        vec_path, _, deleted_path = self._paths(namespace)
+        if not os.path.exists(self._dir(namespace)):
+            return
+        with self._write_lock(namespace):
+            # Rows appended later (a re-upload under the same ids) stay live
+            rows = os.path.getsize(vec_path) // (self.dtype.itemsize * EMBEDDING_DIMENSION) if os.path.exists(vec_path) else 0
+            with open(deleted_path, "a", encoding="utf-8") as f:
+                for id_ in ids:
+                    f.write(json.dumps([id_, rows]) + "\n")
+            self._cache.pop(namespace, None)
+
+    @timed("local_vectors.delete_namespace")
+    def delete_namespace(self, namespace):
+        with self._lock:
+            self._cache.pop(namespace, None)
+            shutil.rmtree(self._dir(namespace), ignore_errors=True)
+
+def _matches(metadata: dict, filter: dict) -> bool:
+    """Supports the Pinecone filter subset we use: {"field": value | {"$eq": v} | {"$in": [...]}}."""
+    for field, condition in filter.items():
+        value = metadata.get(field)
+        if isinstance(condition, dict):
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+BACKENDS = {
+    "pinecone": PineconeVectorStoreBackend,
+    "local": LocalVectorStoreBackend,
+}
+
+@lru_cache(maxsize=1)
+def get_vector_store() -> VectorStore:
+    """Process-wide vector store selected by VECTOR_STORE_BACKEND."""
+    if VECTOR_STORE_BACKEND not in BACKENDS:
+        raise ValueError(f"Unknown VECTOR_STORE_BACKEND '{VECTOR_STORE_BACKEND}'. Use one of: {', '.join(BACKENDS)}")
+    return BACKENDS[VECTOR_STORE_BACKEND]()
@@ -0,0 +1,155 @@
+import os
+import threading
+from collections import OrderedDict, defaultdict
+import numpy as np
+import redis
+from app.utils.rate_limiter import redis_client
+from app.utils.local_db import LocalDB, data_path
+
+# Configuration
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # cosine similarity
+ANSWER_CACHE_MAX_PER_NOTEBOOK = int(os.getenv("ANSWER_CACHE_MAX_PER_NOTEBOOK", "64"))
+GENERATIONS_PATH = data_path("answer_generations.sqlite")
+
+class _SharedGenerations:
+    """
+    Namespace -> generation counters in a local SQLite file, used when Redis
+    isn't configured. Ingestion workers are separate processes, so an
+    in-memory counter bumped there would never reach the API's cache.
+    """
+
+    def __init__(self, path: str):
+        self._db = LocalDB(path, "CREATE TABLE IF NOT EXISTS generations (namespace TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+
+    def get(self, namespace: str) -> int:
+        with self._db.connect() as conn:
+            row = conn.execute("SELECT generation FROM generations WHERE namespace = ?", (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, namespace: str):
+        with self._db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO generations (namespace, generation) VALUES (?, 1) "
+                "ON CONFLICT (namespace) DO UPDATE SET generation = generation + 1",
+                (namespace,)
+            )
+
+class SemanticAnswerCache:
+    """
+    Per-notebook cache of chat answers, looked up by query embedding.
+    A question whose embedding has cosine similarity >= threshold with a cached
+    question gets the cached answer and sources back without touching Pinecone
+    or Gemini. Each notebook holds at most `max_entries` answers (LRU).
+
+    Answers given mid-conversation are tagged with a context key (derived from
+    the previous answer) and are only reused in that same context, since a
+    follow-up like "what about the second one?" means nothing on its own.
+    Answers given with no prior context are reusable everywhere.
+
+    Every namespace has a generation number that ingestion and deletion bump
+    through invalidate(). It lives in Redis when REDIS_URL is configured, and
+    otherwise in a SQLite file under CORTEX_DATA_DIR, so an upload handled by
+    an ingestion worker process (or another API worker) invalidates every
+    process's cache.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, max_entries: int = ANSWER_CACHE_MAX_PER_NOTEBOOK):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries = defaultdict(OrderedDict)  # namespace -> {entry_id: (unit_vector, result, context_key)}
+        self._generations = defaultdict(int)      # namespace -> generation the entries belong to
+        self._shared = _SharedGenerations(GENERATIONS_PATH)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, namespace: str) -> int:
+        if redis_client:
+            try:
+                value = redis_client.get(f"answer_cache:gen:{namespace}")
+                return int(value) if value else 0
+            except redis.RedisError as e:
+                print(f"Redis answer cache error: {e}")
+                with self._lock:
+                    return self._generations[namespace]
+        return self._shared.get(namespace)
+
+    def lookup(self, namespace: str, query_vector, context_key: str = None):
+        """Returns (result or None, generation). Pass the generation back to store()."""
+        generation = self.generation(namespace)
+        query = _unit(query_vector)
+
+        with self._lock:
+            self._sync_generation(namespace, generation)
+            entries = self._entries.get(namespace)
+            if not entries:
+                self.misses += 1
+                return None, generation
+
+            ids = [i for i, entry in entries.items() if entry[2] is None or entry[2] == context_key]
+            if not ids:
+                self.misses += 1
+                return None, generation
+            matrix = np.stack([entries[i][0] for i in ids])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None, generation
+
+            entries.move_to_end(ids[best])
+            self.hits += 1
+            return entries[ids[best]][1], generation
+
+    def store(self, namespace: str, query_vector, result: dict, generation: int, context_key: str = None):
+        if not result.get("answer", "").strip():
+            return
+        # Don't cache an answer computed against content that changed mid-request
+        if self.generation(namespace) != generation:
+            return
+
+        with self._lock:
+            self._sync_generation(namespace, generation)
+            entries = self._entries[namespace]
+            entries[self._next_id] = (_unit(query_vector), result, context_key)
+            self._next_id += 1
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, namespace: str):
+        if redis_client:
+            try:
+                redis_client.incr(f"answer_cache:gen:{namespace}")
+            except redis.RedisError as e:
+                print(f"Redis answer cache error: {e}")
+        else:
+            self._shared.incr(namespace)
+        with self._lock:
+            self._generations[namespace] += 1
+            self._entries.pop(namespace, None)
+
+    def _sync_generation(self, namespace: str, generation: int):
+        # Caller holds the lock. Entries from an older generation are stale.
+        if self._generations[namespace] != generation:
+            self._generations[namespace] = generation
+            self._entries.pop(namespace, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "notebooks": len(self._entries),
+                "entries": sum(len(e) for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+def _unit(vector) -> np.ndarray:
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(arr)
+    return arr / norm if norm else arr
+
+# Process-wide cache shared by RagService and the ingestion/deletion paths
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,122 @@
+import os
+from functools import lru_cache
+from typing import List, Tuple
+from langchain_core.documents import Document
+
+# Configuration
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# The splitter overlaps chunks by up to 200 chars; look a bit further to be safe
+MAX_OVERLAP_CHARS = 400
+MIN_OVERLAP_CHARS = 20
+# Don't bother squeezing in a truncated fragment smaller than this
+MIN_FRAGMENT_TOKENS = 50
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        # Gemini's tokenizer isn't public; cl100k_base is a close enough proxy for budgeting
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"⚠️ tiktoken unavailable, estimating tokens from length: {e}")
+        return None
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def _truncate(text: str, max_tokens: int) -> str:
+    encoding = _encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of `a` that is a prefix of `b` (0 if under MIN_OVERLAP_CHARS)."""
+    tail = a[-MAX_OVERLAP_CHARS:]
+    probe = b[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return 0
+    start = tail.find(probe)
+    while start != -1:
+        if b.startswith(tail[start:]):
+            return len(tail) - start
+        start = tail.find(probe, start + 1)
+    return 0
+
+def _merge(a: str, b: str):
+    """Joins two chunks of the same page if they overlap or one contains the other; None otherwise."""
+    if b in a:
+        return a
+    if a in b:
+        return b
+    overlap = _overlap(a, b)
+    if overlap:
+        return a + b[overlap:]
+    overlap = _overlap(b, a)
+    if overlap:
+        return b + a[overlap:]
+    return None
+
+def pack_context(docs: List[Document], budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, List[Document]]:
+    """
+    Builds the prompt context from ranked chunks.
+    Overlapping/adjacent chunks from the same source and page are merged so
+    the splitter's overlap isn't paid for twice, then merged segments are added
+    in rank order until the token budget is spent. Returns the context text and
+    the documents that made it in (for citing sources); of a segment cut short
+    by the budget, only the chunks that start inside the kept text count.
+    """
+    # 1. Merge overlapping chunks per (source, page), keeping best-rank order
+    segments = []  # [key, text, [docs]]
+    for doc in docs:
+        key = (doc.metadata.get("source"), doc.metadata.get("page"))
+        for segment in segments:
+            if segment[0] != key:
+                continue
+            merged = _merge(segment[1], doc.page_content)
+            if merged is not None:
+                segment[1] = merged
+                segment[2].append(doc)
+                break
+        else:
+            segments.append([key, doc.page_content, [doc]])
+
+    # A chunk can bridge two earlier segments (chunk 2 arrives after 1 and 3)
+    merged_any = True
+    while merged_any:
+        merged_any = False
+        for i, first in enumerate(segments):
+            for second in segments[i + 1:]:
+                if first[0] != second[0]:
+                    continue
+                merged = _merge(first[1], second[1])
+                if merged is not None:
+                    first[1] = merged
+                    first[2].extend(second[2])
+                    segments.remove(second)
+                    merged_any = True
+                    break
+            if merged_any:
+                break
+
+    # 2. Pack into the budget
+    parts, used_docs, used_tokens = [], [], 0
+    for _, text, segment_docs in segments:
+        tokens = count_tokens(text)
+        remaining = budget - used_tokens
+        if tokens > remaining:
+            if remaining < MIN_FRAGMENT_TOKENS:
+                break
+            # Merging never rewrites a chunk, so each chunk's text sits verbatim
+            # in the segment; cite only the chunks that start before the cut
+            kept = _truncate(text, remaining)
+            segment_docs = [doc for doc in segment_docs if text.find(doc.page_content) < len(kept)]
+            text, tokens = kept, remaining
+        parts.append(text)
+        used_docs.extend(segment_docs)
+        used_tokens += tokens
+
+    return "\n\n".join(parts), used_docs
@@ -0,0 +1,240 @@
+import os
+import re
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import redis
+from langchain_core.embeddings import Embeddings
+from app.utils.rate_limiter import redis_client
+from app.utils.metrics import stage
+from app.utils.local_db import LocalDB, data_path
+
+# Configuration
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "2048"))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 86400)))  # Redis tier, seconds
+CHUNK_CACHE_PATH = data_path("chunk_embeddings.sqlite")
+CHUNK_CACHE_TTL = int(os.getenv("CHUNK_CACHE_TTL", str(30 * 86400)))  # Redis tier, seconds
+
+def normalize_text(text: str) -> str:
+    """Unicode-normalizes and collapses whitespace so trivial variants share a key."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+def cache_key(model: str, text: str) -> str:
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"emb:{model}:{digest}"
+
+def chunk_cache_key(model: str, text: str) -> str:
+    # Document-side vectors differ from query-side ones, so they get their own keys
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"emb:doc:{model}:{digest}"
+
+def to_bytes(vector: List[float]) -> bytes:
+    # 3072 float32s = 12 KB, versus ~100 KB as a list of Python floats
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+def from_bytes(blob: bytes) -> List[float]:
+    return np.frombuffer(blob, dtype=np.float32).tolist()
+
+class _LRUBytes:
+    """Thread-safe bounded LRU of key -> float32 bytes."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            blob = self._data.get(key)
+            if blob is not None:
+                self._data.move_to_end(key)
+            return blob
+
+    def put(self, key: str, blob: bytes):
+        with self._lock:
+            self._data[key] = blob
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+class _SqliteBytes:
+    """Persistent key -> float32 bytes store for chunk vectors (one SQLite file)."""
+
+    def __init__(self, path: str):
+        self._db = LocalDB(path, "CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        found = {}
+        with self._db.connect() as conn:
+            # SQLite caps bound parameters per statement; 500 is safe everywhere
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(conn.execute(f"SELECT key, vector FROM vectors WHERE key IN ({placeholders})", batch))
+        return found
+
+    def put_many(self, items: Dict[str, bytes]):
+        with self._db.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO vectors (key, vector) VALUES (?, ?)", items.items())
+
+    def __len__(self):
+        with self._db.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+# Shared by every CachedEmbeddings instance: keys don't depend on the API key,
+# so BYOK users asking the same question share vectors
+_memory_cache = _LRUBytes(EMBEDDING_CACHE_MAX_ENTRIES)
+# Chunk vectors, shared across notebooks and users: a re-uploaded PDF or a
+# paper two users both upload is embedded once
+_chunk_cache = _SqliteBytes(CHUNK_CACHE_PATH)
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model with a two-tier query cache:
+    a bounded in-process LRU, then Redis (when REDIS_URL is set).
+    Keys are model name + normalized text; vectors are stored as float32 bytes.
+
+    Document chunks go through a separate content-addressed cache: a local
+    SQLite file, then Redis. Only chunks missing from both are sent to the
+    model, in one call.
+    """
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", embeddings.__class__.__name__)
+        self.hits = 0
+        self.misses = 0
+
+    # --- Cache tiers ---
+    def _get(self, key: str) -> Optional[List[float]]:
+        blob = _memory_cache.get(key)
+        if blob is None and redis_client:
+            try:
+                blob = redis_client.get(key)
+                if blob is not None:
+                    _memory_cache.put(key, blob)
+            except redis.RedisError as e:
+                print(f"Redis embedding cache error: {e}")
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return from_bytes(blob)
+
+    def _put(self, key: str, vector: List[float]):
+        blob = to_bytes(vector)
+        _memory_cache.put(key, blob)
+        if redis_client:
+            try:
+                redis_client.set(key, blob, ex=EMBEDDING_CACHE_TTL)
+            except redis.RedisError as e:
+                print(f"Redis embedding cache error: {e}")
+
+    # --- Embeddings interface ---
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key(self.model, text)
+        vector = self._get(key)
+        if vector is None:
+            with stage("gemini.embed_query"):
+                vector = self.embeddings.embed_query(text)
+            self._put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = cache_key(self.model, text)
+        # Only the Redis tier does I/O; keep the memory-only path on the loop
+        vector = await asyncio.to_thread(self._get, key) if redis_client else self._get(key)
+        if vector is None:
+            with stage("gemini.embed_query"):
+                vector = await self.embeddings.aembed_query(text)
+            if redis_client:
+                await asyncio.to_thread(self._put, key, vector)
+            else:
+                self._put(key, vector)
+        return vector
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Query vectors for many texts: cache hits first, then one batched call for the rest."""
+        keys = [cache_key(self.model, text) for text in texts]
+        vectors = [await asyncio.to_thread(self._get, key) if redis_client else self._get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            with stage("gemini.embed_queries"):
+                # Batch endpoint, but still query-side vectors so they match embed_query()
+                fresh = await self.embeddings.aembed_documents(
+                    [texts[i] for i in missing], task_type="RETRIEVAL_QUERY"
+                )
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+                if redis_client:
+                    await asyncio.to_thread(self._put, keys[i], vector)
+                else:
+                    self._put(keys[i], vector)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors, _ = self.embed_documents_with_stats(texts)
+        return vectors
+
+    def embed_documents_with_stats(self, texts: List[str]) -> Tuple[List[List[float]], int]:
+        """Like embed_documents(), also returning how many chunks came from the cache."""
+        keys = [chunk_cache_key(self.model, text) for text in texts]
+        blobs = self._get_chunks(list(set(keys)))
+        hits = sum(1 for key in keys if key in blobs)
+
+        # Identical chunks within one upload are embedded once too
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in blobs:
+                missing.setdefault(key, text)
+        if missing:
+            with stage("gemini.embed_documents"):
+                fresh = self.embeddings.embed_documents(list(missing.values()))
+            new_blobs = {key: to_bytes(vector) for key, vector in zip(missing, fresh)}
+            self._put_chunks(new_blobs)
+            blobs.update(new_blobs)
+
+        return [from_bytes(blobs[key]) for key in keys], hits
+
+    def _get_chunks(self, keys: List[str]) -> Dict[str, bytes]:
+        blobs = _chunk_cache.get_many(keys)
+        remaining = [key for key in keys if key not in blobs]
+        if remaining and redis_client:
+            try:
+                from_redis = {k: v for k, v in zip(remaining, redis_client.mget(remaining)) if v is not None}
+                if from_redis:
+                    _chunk_cache.put_many(from_redis)
+                    blobs.update(from_redis)
+            except redis.RedisError as e:
+                print(f"Redis embedding cache error: {e}")
+        return blobs
+
+    def _put_chunks(self, blobs: Dict[str, bytes]):
+        _chunk_cache.put_many(blobs)
+        if redis_client:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for key, blob in blobs.items():
+                    pipe.set(key, blob, ex=CHUNK_CACHE_TTL)
+                pipe.execute()
+            except redis.RedisError as e:
+                print(f"Redis embedding cache error: {e}")
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "memory_entries": len(_memory_cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -2,6 +2,7 @@ import os
 import base64
 from cryptography.fernet import Fernet
 from dotenv import load_dotenv
+from app.utils.metrics import timed
 
 load_dotenv()
 
@@ -18,6 +19,7 @@ def encrypt_key(plain_key: str) -> str:
     encrypted_bytes = fernet_cipher.encrypt(plain_key.encode())
     return encrypted_bytes.decode('utf-8')
 
+@timed("key.decrypt")
 def decrypt_key(encrypted_key: str) -> str:
     """Decrypts an encrypted API key back to plaintext."""
     if not fernet_cipher:
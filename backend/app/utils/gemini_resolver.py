@@ -2,10 +2,12 @@ import os
 from fastapi import HTTPException
 from app.db import get_user_gemini_key
 from app.utils.encryption import decrypt_key
+from app.utils.metrics import timed
 
 ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
 SERVER_GEMINI_KEY = os.getenv("GOOGLE_API_KEY")
 
+@timed("key.resolve")
 def resolve_gemini_key(user_id: str, user_email: str) -> str:
     """
     Resolves the Gemini API key to use for a particular request.
@@ -0,0 +1,160 @@
+import os
+import re
+import gzip
+import json
+import math
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+from langchain_core.documents import Document
+from app.utils.local_db import data_path, file_lock
+
+# Configuration
+KEYWORD_INDEX_DIR = data_path("keyword_index")
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+
+# Keeps part numbers, versions and acronyms ("x-200", "v2.1", "gdpr") as single tokens
+_TOKEN_RE = re.compile(r"\w+(?:[-.]\w+)*")
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+class _Bm25Namespace:
+    """In-memory BM25 postings for one notebook, rebuilt from the on-disk chunks."""
+
+    def __init__(self, docs: List[Document]):
+        self.docs = docs
+        self.term_freqs = [Counter(tokenize(d.page_content)) for d in docs]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        self.doc_freqs = Counter()
+        for tf in self.term_freqs:
+            self.doc_freqs.update(tf.keys())
+
+    def search(self, query: str, k: int, file_names: Optional[Set[str]] = None) -> List[Tuple[Document, float]]:
+        terms = set(tokenize(query))
+        n = len(self.docs)
+        if not terms or not n:
+            return []
+
+        scores = []
+        for i, tf in enumerate(self.term_freqs):
+            if file_names is not None and self.docs[i].metadata.get("file_name") not in file_names:
+                continue
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if not freq:
+                    continue
+                df = self.doc_freqs[term]
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[i] / self.avg_length)
+                score += idf * freq * (BM25_K1 + 1) / (freq + norm)
+            if score > 0:
+                scores.append((score, i))
+
+        scores.sort(reverse=True)
+        return [(self.docs[i], score) for score, i in scores[:k]]
+
+class KeywordIndex:
+    """
+    Per-notebook sparse (BM25) index over the same chunks that go to Pinecone.
+    Chunks are appended to a gzipped JSON-lines file per namespace
+    ({CORTEX_DATA_DIR}/keyword_index/<notebook_id>.jsonl.gz); postings are
+    built in memory on first query and rebuilt when the file changes.
+    Ingestion workers append while the API process may rewrite (deletes), so
+    every access holds a per-namespace file lock as well as the thread lock.
+    """
+
+    def __init__(self, root: str = KEYWORD_INDEX_DIR):
+        self.root = root
+        self._loaded: Dict[str, Tuple[tuple, _Bm25Namespace]] = {}  # namespace -> ((mtime_ns, size), index)
+        self._lock = threading.Lock()
+
+    def _path(self, namespace: str) -> str:
+        safe_name = re.sub(r"[^\w-]", "_", namespace)
+        return os.path.join(self.root, f"{safe_name}.jsonl.gz")
+
+    def _file_lock(self, namespace: str, shared: bool = False):
+        return file_lock(self._path(namespace) + ".lock", shared=shared)
+
+    def add_documents(self, namespace: str, docs: List[Document]):
+        if not docs:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with self._lock, self._file_lock(namespace):
+            # gzip members concatenate, so appending never rewrites earlier chunks
+            with gzip.open(self._path(namespace), "at", encoding="utf-8") as f:
+                for d in docs:
+                    f.write(json.dumps({"text": d.page_content, "metadata": d.metadata}, default=str) + "\n")
+            self._loaded.pop(namespace, None)
+
+    def _load(self, namespace: str):
+        path = self._path(namespace)
+        if not os.path.exists(path):
+            return None
+        # Shared lock: never read (or cache) a member another process is still writing
+        with self._lock, self._file_lock(namespace, shared=True):
+            if not os.path.exists(path):
+                return None
+            stat = os.stat(path)
+            version = (stat.st_mtime_ns, stat.st_size)
+            cached = self._loaded.get(namespace)
+            if cached and cached[0] == version:
+                return cached[1]
+            docs = []
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    row = json.loads(line)
+                    docs.append(Document(page_content=row["text"], metadata=row["metadata"]))
+            index = _Bm25Namespace(docs)
+            self._loaded[namespace] = (version, index)
+            return index
+
+    def search(self, namespace: str, query: str, k: int, file_names: Optional[List[str]] = None) -> List[Tuple[Document, float]]:
+        """`file_names` restricts hits to chunks of those notebook files (metadata["file_name"])."""
+        index = self._load(namespace)
+        if not index:
+            return []
+        return index.search(query, k, set(file_names) if file_names else None)
+
+    def delete_documents(self, namespace: str, chunk_ids: List[str]):
+        """Drops chunks by metadata["chunk_id"]. Rewrites the namespace file, so meant for small diffs."""
+        path = self._path(namespace)
+        ids = set(chunk_ids)
+        if not ids or not os.path.exists(path):
+            return
+        # Read and replace under one exclusive lock, so rows appended meanwhile aren't dropped
+        with self._lock, self._file_lock(namespace):
+            if not os.path.exists(path):
+                return
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                kept = [line for line in f if json.loads(line)["metadata"].get("chunk_id") not in ids]
+            tmp_path = path + ".tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.writelines(kept)
+            os.replace(tmp_path, path)
+            self._loaded.pop(namespace, None)
+
+    def delete_namespace(self, namespace: str):
+        with self._lock, self._file_lock(namespace):
+            self._loaded.pop(namespace, None)
+            path = self._path(namespace)
+            if os.path.exists(path):
+                os.remove(path)
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Document]], k: int = RRF_K) -> List[Document]:
+    """Merges ranked result lists: score(d) = sum over lists of 1 / (k + rank)."""
+    scores: Dict[tuple, float] = {}
+    docs: Dict[tuple, Document] = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked, start=1):
+            key = (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+# Process-wide index shared by ingestion and retrieval
+keyword_index = KeywordIndex()
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking (run a single process there)
+    fcntl = None
+
+# Local state: caches, manifests, the job queue, local vectors (gitignored)
+DATA_DIR = os.getenv("CORTEX_DATA_DIR", ".cortex")
+
+def data_path(*parts: str) -> str:
+    return os.path.join(DATA_DIR, *parts)
+
+@contextmanager
+def file_lock(path: str, shared: bool = False):
+    """
+    Cross-process lock on `path` (created if missing) for files that the API
+    process and ingestion workers both write. Readers pass shared=True.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class LocalDB:
+    """
+    A SQLite file under DATA_DIR with one connection per process, shared by
+    its threads under a lock. Opened lazily so importing never touches disk;
+    `schema` (and then `migrate`, for columns added later) run on open.
+    Other processes open their own connection; WAL lets them read while one writes.
+    """
+
+    def __init__(self, path: str, schema: str, migrate: Optional[Callable[[sqlite3.Connection], None]] = None):
+        self.path = path
+        self.schema = schema
+        self.migrate = migrate
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Caller holds the lock
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.schema)
+            if self.migrate:
+                self.migrate(conn)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def connect(self):
+        """The shared connection, for reads."""
+        with self._lock:
+            yield self._connection()
+
+    @contextmanager
+    def transaction(self):
+        """The shared connection inside a transaction, committed on exit."""
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                yield conn
@@ -0,0 +1,135 @@
+import os
+import time
+import atexit
+import shutil
+import tempfile
+import functools
+import inspect
+import contextvars
+from contextlib import contextmanager
+
+# Ingestion runs in worker processes (see job_worker), so metrics use
+# prometheus_client's multiprocess mode: every process writes its samples
+# under this directory and /metrics aggregates them. Must be set before
+# prometheus_client is imported; spawned workers inherit it from the API.
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="cortex-metrics-")
+    atexit.register(shutil.rmtree, os.environ["PROMETHEUS_MULTIPROC_DIR"], True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+
+# LLM calls run for seconds, cache hits for microseconds; cover both ends
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_DURATION = Histogram(
+    "cortex_stage_duration_seconds",
+    "Time spent in one stage of a request (auth, db, gemini, vector query, ...)",
+    ["stage", "outcome"],
+    buckets=BUCKETS,
+)
+STAGE_TOTAL = Counter(
+    "cortex_stage_total",
+    "Number of times a stage ran",
+    ["stage", "outcome"],
+)
+HTTP_DURATION = Histogram(
+    "cortex_http_request_duration_seconds",
+    "Time until the response headers were sent",
+    ["method", "route", "status"],
+    buckets=BUCKETS,
+)
+
+# Per-request list of (stage, seconds); set by ServerTimingMiddleware
+_request_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+def _record(name: str, outcome: str, elapsed: float):
+    STAGE_DURATION.labels(name, outcome).observe(elapsed)
+    STAGE_TOTAL.labels(name, outcome).inc()
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, elapsed))
+
+@contextmanager
+def stage(name: str):
+    """Times a block as `name`. Works in sync and async code alike."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _record(name, outcome, time.perf_counter() - start)
+
+def timed(name: str):
+    """Decorator form of stage() for plain and async functions."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _server_timing_header(timings, total: float) -> bytes:
+    # Aggregate repeated stages (e.g. several Supabase calls) into one entry each
+    totals, counts = {}, {}
+    for name, elapsed in timings:
+        totals[name] = totals.get(name, 0.0) + elapsed
+        counts[name] = counts.get(name, 0) + 1
+    metric_name = lambda name: name.replace(".", "_").replace(":", "_")
+    parts = [
+        f'{metric_name(name)};dur={seconds * 1000:.1f};desc="{name} x{counts[name]}"'
+        for name, seconds in totals.items()
+    ]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts).encode("latin-1")
+
+class ServerTimingMiddleware:
+    """
+    Pure ASGI middleware: collects stage timings for each HTTP request, adds a
+    Server-Timing header when the response starts, and records request latency.
+    Stages that run after the headers go out (streamed bodies, background
+    tasks) still reach Prometheus, just not the header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = []
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                total = time.perf_counter() - start
+                route = scope.get("route")
+                path = getattr(route, "path", "unmatched")
+                HTTP_DURATION.labels(scope["method"], path, str(message["status"])).observe(total)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", _server_timing_header(timings, total)))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+
+def metrics_response_body():
+    # Samples from this process and every ingestion worker
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
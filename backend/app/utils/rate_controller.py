@@ -0,0 +1,64 @@
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+def is_rate_limited(error: Exception) -> bool:
+    """True for Gemini quota errors (HTTP 429 / RESOURCE_EXHAUSTED) and similar."""
+    message = str(error)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message or "rate limit" in message.lower()
+
+class AdaptiveRateController:
+    """
+    AIMD concurrency limit for calls against a rate-limited API.
+    Every success raises the limit by about one slot per `limit` successes
+    (additive increase); every throttle halves it and pauses new calls for a
+    growing backoff (multiplicative decrease). Threads take a slot with
+    `with controller.slot():` and report the outcome.
+    """
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1, backoff_base: float = 1.0, backoff_max: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limit = float(max_concurrency)
+        self._active = 0
+        self._throttle_streak = 0
+        self._resume_at = 0.0
+        self._cond = threading.Condition()
+        self.throttles = 0
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait <= 0 and self._active < int(self.limit):
+                    break
+                self._cond.wait(timeout=wait if wait > 0 else None)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._throttle_streak = 0
+            self.limit = min(self.max_concurrency, self.limit + 1 / max(self.limit, 1))
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.throttles += 1
+            self._throttle_streak += 1
+            self.limit = max(self.min_concurrency, self.limit / 2)
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (self._throttle_streak - 1))
+            self._resume_at = max(self._resume_at, time.monotonic() + delay * random.uniform(0.5, 1.0))
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"limit": round(self.limit, 2), "active": self._active, "throttles": self.throttles}
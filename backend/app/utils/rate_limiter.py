@@ -17,17 +17,19 @@ ONE_DAY = 86400
 redis_url = os.getenv("REDIS_URL")
 redis_client = redis.Redis.from_url(redis_url) if redis_url else None
 
-def check_rate_limit(user_id: str):
+def check_rate_limit(user_id: str, units: int = 1):
     """
     Checks if a user has exceeded their rate limit.
     Raises HTTPException 429 if exceeded.
+    `units` is charged against the daily limit (e.g. one per question in a
+    batch); the per-minute limit counts the call once.
     """
     if redis_client:
-        _check_rate_limit_redis(user_id)
+        _check_rate_limit_redis(user_id, units)
     else:
-        _check_rate_limit_memory(user_id)
+        _check_rate_limit_memory(user_id, units)
 
-def _check_rate_limit_redis(user_id: str):
+def _check_rate_limit_redis(user_id: str, units: int = 1):
     try:
         current_minute = int(time.time() // ONE_MINUTE)
         current_day = int(time.time() // ONE_DAY)
@@ -40,8 +42,8 @@ def _check_rate_limit_redis(user_id: str):
         if req_minute == 1:
             redis_client.expire(minute_key, ONE_MINUTE * 2)
 
-        req_day = redis_client.incr(day_key)
-        if req_day == 1:
+        req_day = redis_client.incrby(day_key, units)
+        if req_day == units:
             redis_client.expire(day_key, ONE_DAY * 2)
 
         if req_day > MAX_REQUESTS_PER_DAY:
@@ -58,22 +60,22 @@ def _check_rate_limit_redis(user_id: str):
         # Re-raise standard HTTP exceptions
         raise 
 
-def _check_rate_limit_memory(user_id: str):
+def _check_rate_limit_memory(user_id: str, units: int = 1):
     now = time.time()
     user_requests = rate_limits[user_id]
 
     # Clean up old requests (older than a day)
     user_requests = [req_time for req_time in user_requests if now - req_time < ONE_DAY]
     
-    # Count requests in the last minute
-    requests_last_minute = sum(1 for req_time in user_requests if now - req_time < ONE_MINUTE)
+    # Count requests in the last minute (a batch's extra units share one timestamp)
+    requests_last_minute = len({req_time for req_time in user_requests if now - req_time < ONE_MINUTE})
 
-    if len(user_requests) >= MAX_REQUESTS_PER_DAY:
+    if len(user_requests) + units > MAX_REQUESTS_PER_DAY:
         raise HTTPException(status_code=429, detail=f"Daily rate limit exceeded ({MAX_REQUESTS_PER_DAY} requests/day).")
     
     if requests_last_minute >= MAX_REQUESTS_PER_MINUTE:
         raise HTTPException(status_code=429, detail=f"Per-minute rate limit exceeded ({MAX_REQUESTS_PER_MINUTE} requests/minute).")
 
     # Add the current request
-    user_requests.append(now)
+    user_requests.extend([now] * units)
     rate_limits[user_id] = user_requests
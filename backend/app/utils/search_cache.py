@@ -0,0 +1,147 @@
+import os
+import re
+import time
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple
+from langchain_core.tools import BaseTool
+from app.utils.metrics import stage
+
+# Configuration
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "1800"))  # seconds
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1024"))
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query.strip().lower())
+
+class SingleFlightCache:
+    """
+    TTL cache with single-flight coalescing: while a key is being computed,
+    every other caller (thread or coroutine) waits on the same Future instead
+    of starting its own call.
+    """
+
+    def __init__(self, ttl: int = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._values: Dict[str, Tuple[float, Any]] = {}  # key -> (expires_at, value)
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _claim(self, key: str):
+        """Returns (cached value, future to wait on, whether we are the leader)."""
+        with self._lock:
+            entry = self._values.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1], None, False
+            future = self._in_flight.get(key)
+            if future:
+                self.coalesced += 1
+                return None, future, False
+            self.misses += 1
+            future = Future()
+            self._in_flight[key] = future
+            return None, future, True
+
+    def _settle(self, key: str, future: Future, value: Any = None, error: Optional[BaseException] = None, cacheable: bool = True):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if error is None and cacheable:
+                if len(self._values) >= self.max_entries:
+                    self._evict()
+                self._values[key] = (time.monotonic() + self.ttl, value)
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def _evict(self):
+        # Caller holds the lock. Drop expired entries, then the soonest to expire.
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._values.items() if expires_at <= now]:
+            del self._values[key]
+        if len(self._values) >= self.max_entries:
+            del self._values[min(self._values, key=lambda k: self._values[k][0])]
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any], is_cacheable: Callable[[Any], bool] = lambda v: True):
+        value, future, leader = self._claim(key)
+        if future is None:
+            return value
+        if not leader:
+            return future.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, value, cacheable=is_cacheable(value))
+        return value
+
+    async def aget_or_compute(self, key: str, compute, is_cacheable: Callable[[Any], bool] = lambda v: True):
+        value, future, leader = self._claim(key)
+        if future is None:
+            return value
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            value = await compute()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, value, cacheable=is_cacheable(value))
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._values),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": round((self.hits + self.coalesced) / total, 4) if total else 0.0,
+            }
+
+# Process-wide cache: web results don't depend on the user's Gemini key
+search_cache = SingleFlightCache()
+
+def _is_successful(result) -> bool:
+    # Tavily reports failures as (repr(error), {}); never cache those
+    content, _ = result
+    return isinstance(content, list)
+
+class CachedSearchTool(BaseTool):
+    """
+    Drop-in wrapper around TavilySearchResults: same name, schema and
+    content_and_artifact output, backed by `search_cache`.
+    """
+
+    tool: BaseTool
+    response_format: str = "content_and_artifact"
+
+    def __init__(self, tool: BaseTool, **kwargs):
+        super().__init__(
+            tool=tool,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema,
+            **kwargs
+        )
+
+    def _run(self, query: str, run_manager=None):
+        with stage("tavily.search"):
+            return search_cache.get_or_compute(
+                normalize_query(query), lambda: self.tool._run(query), _is_successful
+            )
+
+    async def _arun(self, query: str, run_manager=None):
+        with stage("tavily.search"):
+            return await search_cache.aget_or_compute(
+                normalize_query(query), lambda: self.tool._arun(query), _is_successful
+            )
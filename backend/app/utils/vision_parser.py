@@ -1,29 +1,135 @@
+import io
+import os
+import re
+import json
+import time
+import random
+import hashlib
 import fitz  # PyMuPDF
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from PIL import Image
 from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
+from app.utils.metrics import stage
+from app.utils.rate_controller import is_rate_limited
+from app.utils.local_db import LocalDB, data_path
+
+# Configuration
+VISION_MAX_WORKERS = int(os.getenv("VISION_MAX_WORKERS", "4"))  # concurrent description calls
+VISION_TIMEOUT = float(os.getenv("VISION_TIMEOUT", "60"))       # seconds per Gemini request
+VISION_MAX_RETRIES = 3
+VISION_BACKOFF_BASE = 2.0  # seconds; doubles per retry, with jitter
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))  # px; larger images are downscaled
+VISION_JPEG_QUALITY = 85
+VISION_MIN_SIDE = 64       # px; smaller images are icons/bullets
+VISION_CACHE_PATH = data_path("image_descriptions.sqlite")
+VISION_MODEL = "gemini-2.5-flash"
+VISION_PROMPT = "Analyze this image in detail. Read all data values, axis labels, and text inside diagrams. If decorative, return empty string."
+# Several images per request; 1 disables batching. Gemini caps inline request data at 20 MB.
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", "4"))
+VISION_BATCH_MAX_BYTES = int(os.getenv("VISION_BATCH_MAX_BYTES", str(4 * 1024 * 1024)))
+VISION_BATCH_PROMPT = """You are given {count} images, labelled Image 1 to Image {count}.
+For each image: analyze it in detail. Read all data values, axis labels, and text inside diagrams. If it is decorative, use an empty string.
+Return only a JSON array of exactly {count} strings, where element i is the description of Image i. No other text."""
+
+class _DescriptionCache:
+    """
+    Persistent image SHA-256 -> description store shared by every document and
+    user. Keyed by exact content, never by perceptual hash: two charts with the
+    same shape but different labels must not share a description.
+    """
+
+    def __init__(self, path: str):
+        self._db = LocalDB(path, "CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, description TEXT NOT NULL)")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._db.connect() as conn:
+            row = conn.execute("SELECT description FROM descriptions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, description: str):
+        with self._db.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO descriptions (key, description) VALUES (?, ?)", (key, description))
+
+description_cache = _DescriptionCache(VISION_CACHE_PATH)
+
+def perceptual_hash(image: Image.Image, hash_size: int = 16) -> str:
+    """dHash: compares neighbouring pixels of a small grayscale copy. Survives re-encoding and rescaling."""
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+def prepare_image(image_bytes: bytes) -> Optional[Tuple[bytes, str, str]]:
+    """
+    Returns (JPEG bytes no larger than VISION_MAX_SIDE, perceptual hash,
+    SHA-256 of the original bytes), or None for images too small to be worth
+    describing. Formats Pillow can't read are passed through with the content
+    hash standing in for the perceptual one.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+    except Exception:
+        return image_bytes, digest, digest
+
+    if min(image.size) < VISION_MIN_SIDE:
+        return None
+    phash = perceptual_hash(image)
+
+    image = image.convert("RGB")
+    image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    return out.getvalue(), phash, digest
 
 class VisionParser:
     def __init__(self, google_api_key: str):
         # UPDATED: Use the model you confirmed works (2.5-flash)
+        # Retries are ours (see _get_image_summary), so the client doesn't stack its own
         self.vision_llm = ChatGoogleGenerativeAI(
-            model="gemini-2.5-flash",
+            model=VISION_MODEL,
             temperature=0,
-            google_api_key=google_api_key
+            google_api_key=google_api_key,
+            timeout=VISION_TIMEOUT,
+            max_retries=0
         )
+        # Shared by every ingestion on this key, so it also caps concurrent vision calls per key
+        self._pool = ThreadPoolExecutor(max_workers=VISION_MAX_WORKERS, thread_name_prefix="vision")
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        client = getattr(self.vision_llm, "client", None)
+        if client is not None and hasattr(client, "close"):
+            client.close()
 
-    def extract_and_describe_images(self, pdf_path: str):
+    def extract_and_describe_images(self, pdf_path: str, pages=None, seen: Optional[set] = None):
         """
         Iterates through PDF, finds images, sends them to Gemini for description.
-        Returns a list of LangChain Documents containing the descriptions.
+        `pages` limits the scan to those 0-based page numbers (default: all).
+        Repeated images (same xref or same perceptual hash) are described once;
+        pass the same `seen` set across calls on one PDF to dedupe across pages windows.
+        Descriptions from earlier documents are only reused for identical bytes.
+        Extraction is sequential (PyMuPDF documents aren't thread-safe); the
+        descriptions run concurrently on the worker pool.
+        Returns a list of LangChain Documents containing the descriptions, in page order.
         """
         doc = fitz.open(pdf_path)
-        image_docs = []
+        seen = set() if seen is None else seen
+        images = []  # (page_num, content hash, downscaled JPEG) in page order
 
         print(f"👁️ Scanning {pdf_path} for images...")
 
-        for page_num in range(len(doc)):
+        for page_num in (range(len(doc)) if pages is None else pages):
             page = doc[page_num]
             image_list = page.get_images(full=True)
 
@@ -34,6 +140,10 @@ class VisionParser:
 
             for img_index, img in enumerate(image_list):
                 xref = img[0]
+                # Logos and page backgrounds are usually one xref drawn on every page
+                if ("xref", xref) in seen:
+                    continue
+                seen.add(("xref", xref))
                 base_image = doc.extract_image(xref)
                 image_bytes = base_image["image"]
                 
@@ -41,33 +151,145 @@ class VisionParser:
                 if len(image_bytes) < 5000: 
                     continue
 
-                # Get description
-                description = self._get_image_summary(image_bytes)
-                
-                if description:
-                    new_doc = Document(
-                        page_content=f"*** [IMAGE DESCRIPTION] (Page {page_num + 1}) ***\n{description}",
-                        metadata={
-                            "source": f"Image on Page {page_num + 1}",
-                            "page": page_num + 1,
-                            "type": "image_description"
-                        }
-                    )
-                    image_docs.append(new_doc)
+                prepared = prepare_image(image_bytes)
+                if prepared is None:
+                    continue
+                jpeg_bytes, image_hash, content_hash = prepared
+                # ...or the same picture embedded again under a new xref.
+                # Perceptual matches are only trusted within one document.
+                if ("hash", image_hash) in seen:
+                    continue
+                seen.add(("hash", image_hash))
+                images.append((page_num, content_hash, jpeg_bytes))
+
+        doc.close()
+
+        descriptions = self._describe_all([(h, jpeg) for _, h, jpeg in images])
+
+        image_docs = []
+        for (page_num, _, _), description in zip(images, descriptions):
+            if description:
+                new_doc = Document(
+                    page_content=f"*** [IMAGE DESCRIPTION] (Page {page_num + 1}) ***\n{description}",
+                    metadata={
+                        "source": f"Image on Page {page_num + 1}",
+                        "page": page_num + 1,
+                        "type": "image_description"
+                    }
+                )
+                image_docs.append(new_doc)
 
         return image_docs
 
-    def _get_image_summary(self, image_bytes):
-        try:
+    def _describe_all(self, items: List[Tuple[str, bytes]]) -> List[Optional[str]]:
+        """Descriptions for (content hash, image bytes) items, in order: cache first, then batched Gemini calls."""
+        descriptions = [description_cache.get(_cache_key(content_hash)) for content_hash, _ in items]
+        pending = [i for i, description in enumerate(descriptions) if description is None]
+
+        # Pack uncached images into batches bounded by count and payload size
+        batches, current, current_bytes = [], [], 0
+        for i in pending:
+            size = len(items[i][1])
+            if current and (len(current) >= VISION_BATCH_SIZE or current_bytes + size > VISION_BATCH_MAX_BYTES):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(i)
+            current_bytes += size
+        if current:
+            batches.append(current)
+
+        # map() yields results in submission order
+        for batch, results in zip(batches, self._pool.map(lambda b: self._get_batch_summaries([items[i][1] for i in b]), batches)):
+            for i, description in zip(batch, results):
+                descriptions[i] = description
+                # Empty descriptions (decorative images) are cached too; failures are not
+                if description is not None:
+                    description_cache.put(_cache_key(items[i][0]), description)
+        return descriptions
+
+    def _get_batch_summaries(self, images: List[bytes]) -> List[Optional[str]]:
+        if len(images) == 1:
+            return [self._get_image_summary(images[0])]
+        for attempt in range(VISION_MAX_RETRIES + 1):
+            try:
+                return self._describe_batch(images)
+            except ValueError as e:
+                # The model didn't return one parseable entry per image
+                print(f"   ⚠️ Batched vision response unusable ({e}); describing images one by one")
+                break
+            except Exception as e:
+                if attempt == VISION_MAX_RETRIES or not _is_transient(e):
+                    print(f"   ❌ Batched Vision Error: {e}; describing images one by one")
+                    break
+                time.sleep(VISION_BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.0))
+        return [self._get_image_summary(image_bytes) for image_bytes in images]
+
+    def _describe_batch(self, images: List[bytes]) -> List[str]:
+        content = [{"type": "text", "text": VISION_BATCH_PROMPT.format(count=len(images))}]
+        for number, image_bytes in enumerate(images, start=1):
             b64_string = base64.b64encode(image_bytes).decode("utf-8")
-            message = HumanMessage(
-                content=[
-                    {"type": "text", "text": "Analyze this image in detail. Read all data values, axis labels, and text inside diagrams. If decorative, return empty string."},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_string}"}}
-                ]
-            )
+            content.append({"type": "text", "text": f"Image {number}:"})
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_string}"}})
+        with stage("gemini.vision_batch"):
+            response = self.vision_llm.invoke([HumanMessage(content=content)])
+        return parse_batch_descriptions(_message_text(response.content), len(images))
+
+    def _get_image_summary(self, image_bytes):
+        # Timeouts, throttling and 5xx are retried with backoff; anything else skips the image
+        for attempt in range(VISION_MAX_RETRIES + 1):
+            try:
+                return self._describe(image_bytes)
+            except Exception as e:
+                if attempt == VISION_MAX_RETRIES or not _is_transient(e):
+                    print(f"   ❌ Vision Error: {e}")
+                    return None
+                time.sleep(VISION_BACKOFF_BASE * 2 ** attempt * random.uniform(0.5, 1.0))
+
+    def _describe(self, image_bytes):
+        b64_string = base64.b64encode(image_bytes).decode("utf-8")
+        message = HumanMessage(
+            content=[
+                {"type": "text", "text": VISION_PROMPT},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_string}"}}
+            ]
+        )
+        with stage("gemini.vision"):
             response = self.vision_llm.invoke([message])
-            return response.content
-        except Exception as e:
-            print(f"   ❌ Vision Error: {e}")
-            return None
\ No newline at end of file
+        return _message_text(response.content)
+
+def _cache_key(content_hash: str) -> str:
+    # "sha256:" keeps entries written under perceptual-hash keys from ever matching
+    return f"{VISION_MODEL}:sha256:{content_hash}"
+
+def _message_text(content) -> str:
+    if isinstance(content, list):
+        # Gemini 2.5 can answer in parts
+        return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return content
+
+def parse_batch_descriptions(text: str, count: int) -> List[str]:
+    """Parses the JSON array a batched prompt asks for. Raises ValueError unless it has `count` strings."""
+    # Models often wrap JSON in a ```json fence despite being told not to
+    match = re.search(r"\[.*\]", text, re.DOTALL)
+    if not match:
+        raise ValueError("no JSON array in response")
+    try:
+        entries = json.loads(match.group(0))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}")
+    if not isinstance(entries, list) or len(entries) != count:
+        raise ValueError(f"expected {count} entries, got {len(entries) if isinstance(entries, list) else type(entries).__name__}")
+    descriptions = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = entry.get("description", "")
+        if not isinstance(entry, str):
+            raise ValueError("entries must be strings")
+        descriptions.append(entry)
+    return descriptions
+
+def _is_transient(error: Exception) -> bool:
+    if is_rate_limited(error) or isinstance(error, TimeoutError):
+        return True
+    message = str(error)
+    return any(marker in message for marker in ("timed out", "Timeout", "DEADLINE_EXCEEDED", "UNAVAILABLE", "500", "503"))
\ No newline at end of file
@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableLambda
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+# 1. Setup Environment
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+load_dotenv()
+
+# The benchmark never reaches the network, so placeholder keys are enough
+os.environ.setdefault("TAVILY_API_KEY", "benchmark-placeholder")
+# app.services.rag pulls in app.db (conversation memory), which needs Supabase settings at import
+os.environ.setdefault("SUPABASE_URL", "http://localhost")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "benchmark.placeholder.key")
+
+from app.services.rag import build_agent_graph, get_agent_graph, get_search_tool
+
+ITERATIONS = int(os.getenv("BENCHMARK_ITERATIONS", "200"))
+
+# Stub model: answers immediately, so we only measure graph overhead
+stub_llm = RunnableLambda(lambda messages: AIMessage(content="stub answer"))
+
+inputs = {
+    "messages": [
+        SystemMessage(content="You are Cortex."),
+        HumanMessage(content="What is in the PDF?")
+    ]
+}
+
+# Built once, like RagService.__init__ does
+gemini_llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0, google_api_key="benchmark-placeholder")
+
+def per_request_graph():
+    """The old RagService.chat path: bind tools, build and compile on every call."""
+    gemini_llm.bind_tools([get_search_tool()])
+    app = build_agent_graph([get_search_tool()])
+    return app.invoke(inputs, config={"configurable": {"llm": stub_llm}})
+
+def compiled_once_graph():
+    """The current path: reuse the process-wide compiled graph."""
+    return get_agent_graph().invoke(inputs, config={"configurable": {"llm": stub_llm}})
+
+def run(label, fn):
+    fn()  # warm up imports / lazy singletons
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fn()
+    elapsed = time.perf_counter() - start
+    per_call_ms = elapsed / ITERATIONS * 1000
+    print(f"   {label:<22} {per_call_ms:8.3f} ms/request")
+    return per_call_ms
+
+if __name__ == "__main__":
+    print(f"⏱️  Agent graph overhead ({ITERATIONS} iterations, stub LLM)...")
+    before = run("build + compile", per_request_graph)
+    after = run("compiled once", compiled_once_graph)
+    print(f"✅ Saved {before - after:.3f} ms per request ({before / after:.1f}x less overhead)")
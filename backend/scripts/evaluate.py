@@ -2,7 +2,6 @@ import os
 import sys
 import pandas as pd
 import asyncio
-import time  # <--- Added for safety delay
 from dotenv import load_dotenv
 from ragas import evaluate
 from ragas.metrics import Faithfulness, AnswerRelevancy, ContextPrecision
@@ -60,9 +59,10 @@ async def run_evaluation():
 
     # Import Service
     from app.services.rag import RagService
-    rag = RagService()
+    rag = RagService(os.getenv("GOOGLE_API_KEY"))
     # FORCE the service to use the Lite model too, just for this test
     rag.llm = google_llm 
+    rag.llm_with_tools = google_llm.bind_tools([rag.search_tool])
     
     data_samples = {
         "question": df["question"].tolist(),
@@ -73,33 +73,29 @@ async def run_evaluation():
 
     print(f"🚀 Running tests against Notebook ID: {TEST_NOTEBOOK_ID}")
     
-    for q in data_samples["question"]:
-        print(f"   Asking Cortex: '{q}'...")
-        try:
-            # 1. Get Response
-            response = rag.chat(q, notebook_id=TEST_NOTEBOOK_ID)
-            
-            # 2. Extract Answer
-            ans = response["answer"]
-            
-            # 3. Extract Contexts
-            ctx_list = []
-            for s in response["sources"]:
-                content = s.get("page_content") or s.get("content") or str(s)
-                ctx_list.append(content)
-            
-            data_samples["answer"].append(ans)
-            data_samples["contexts"].append(ctx_list)
-            
-            # 4. SAFETY PAUSE (Avoids 429)
-            time.sleep(2) 
+    # 1. Ask everything in one batch: one embedding call, concurrent retrieval,
+    # throttled generations that back off on 429 instead of fixed sleeps
+    print(f"   Asking Cortex {len(data_samples['question'])} questions...")
+    responses = await rag.chat_batch(data_samples["question"], notebook_id=TEST_NOTEBOOK_ID)
 
-        except Exception as e:
-            print(f"   ❌ Error: {e}")
-            if len(data_samples["answer"]) < len(data_samples["question"]):
-                 data_samples["answer"].append("Error")
-            if len(data_samples["contexts"]) < len(data_samples["question"]):
-                 data_samples["contexts"].append(["Error"])
+    for q, response in zip(data_samples["question"], responses):
+        if "error" in response:
+            print(f"   ❌ Error on '{q}': {response['error']}")
+            data_samples["answer"].append("Error")
+            data_samples["contexts"].append(["Error"])
+            continue
+
+        # 2. Extract Answer
+        ans = response["answer"]
+        
+        # 3. Extract Contexts
+        ctx_list = []
+        for s in response["sources"]:
+            content = s.get("page_content") or s.get("content") or str(s)
+            ctx_list.append(content)
+        
+        data_samples["answer"].append(ans)
+        data_samples["contexts"].append(ctx_list)
 
     # 5. Grading
     print("\n👨‍⚖️  The AI Judge is grading the answers...")
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import asyncio
+import statistics
+import httpx
+from dotenv import load_dotenv
+
+# 1. Setup Environment
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+# Config: point this at a running `uvicorn app.main:app --workers 1`
+API_URL = os.getenv("LOAD_TEST_API_URL", "http://localhost:8000/api")
+ACCESS_TOKEN = os.getenv("LOAD_TEST_TOKEN")          # Supabase JWT of a test user
+NOTEBOOK_ID = os.getenv("LOAD_TEST_NOTEBOOK_ID")
+# The per-user rate limit is 5 requests/minute, so stay at or below that per token
+CONCURRENCY = int(os.getenv("LOAD_TEST_CONCURRENCY", "5"))
+QUESTION = os.getenv("LOAD_TEST_QUESTION", "Summarize this notebook in one paragraph.")
+
+async def one_chat(client: httpx.AsyncClient, i: int):
+    start = time.perf_counter()
+    response = await client.post(
+        f"{API_URL}/chat",
+        json={"message": QUESTION, "notebookId": NOTEBOOK_ID},
+        headers={"Authorization": f"Bearer {ACCESS_TOKEN}"},
+    )
+    elapsed = time.perf_counter() - start
+    print(f"   Request {i + 1}: HTTP {response.status_code} in {elapsed:.2f}s")
+    return elapsed, response.status_code
+
+async def run_load_test():
+    if not ACCESS_TOKEN or not NOTEBOOK_ID:
+        print("❌ Error: set LOAD_TEST_TOKEN and LOAD_TEST_NOTEBOOK_ID")
+        sys.exit(1)
+
+    print(f"🚦 Firing {CONCURRENCY} concurrent chats at {API_URL}/chat ...")
+    async with httpx.AsyncClient(timeout=120) as client:
+        wall_start = time.perf_counter()
+        results = await asyncio.gather(*(one_chat(client, i) for i in range(CONCURRENCY)))
+        wall = time.perf_counter() - wall_start
+
+    latencies = [elapsed for elapsed, status in results if status == 200]
+    if not latencies:
+        print("❌ No successful requests.")
+        return
+
+    total = sum(latencies)
+    mean = statistics.mean(latencies)
+    # 1.0 == perfectly overlapped, CONCURRENCY == fully serialized on one worker
+    serialization = wall / mean
+
+    print("\n📊 === LOAD TEST ===")
+    print(f"   Successful:          {len(latencies)}/{CONCURRENCY}")
+    print(f"   Mean latency:        {mean:.2f}s")
+    print(f"   Sum of latencies:    {total:.2f}s")
+    print(f"   Wall time:           {wall:.2f}s")
+    print(f"   Serialization factor {serialization:.2f} (1.0 = concurrent, {len(latencies)} = serialized)")
+
+    if serialization < len(latencies) / 2:
+        print("✅ Concurrent chats overlap on the worker.")
+    else:
+        print("⚠️  Chats look serialized; something is blocking the event loop.")
+
+if __name__ == "__main__":
+    asyncio.run(run_load_test())